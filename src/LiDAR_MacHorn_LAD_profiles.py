@@ -4,82 +4,130 @@ import LiDAR_tools as lidar
 import auxilliary_functions as aux
 
 # bin lidar returns 
-def bin_returns(pts, max_height, layer_thickness):
+# If all_returns is True, the counts for every return number and classification are also
+# returned: counts[k,c,:] is the profile of returns with return number k+1 and class c,
+# and totals[k,c] the number of such returns at any height.
+def bin_returns(pts, max_height, layer_thickness, all_returns=False):
+    R = pts[:,3]
+    C = pts[:,4]
+    z = pts[:,2]
     # filter the points to leave only first returns - not sure why this is necessary, but Cam group suggest - point for discussion
-    #print pts.shape
-    pts=pts[pts[:,3]==1,:]
+    first = R==1
     
     # calculate n ground points
-    n_ground_returns = np.sum(pts[:,4]==2)
-    # filter to consider only veg returns
-    can_pts = pts[pts[:,4]==1,:]
+    n_ground_returns = np.sum(first & (C==2))
     
     # now set up bins
     lower_lims=np.arange(0,max_height,layer_thickness)
     upper_lims = lower_lims + layer_thickness
     n_bins = lower_lims.size
-    profile = np.zeros(n_bins)
     heights = lower_lims+layer_thickness
-    n_returns = can_pts.shape[0]
 
     # bin data
-    bin = can_pts[:,2]//layer_thickness
+    bin = z//layer_thickness
     bin = bin.astype(int)
-
-    for i in range(0,n_returns):
-        if bin[i]<n_bins and bin[i]>=0: # in case there are some spuriously high returns outside the permitted range
-            profile[bin[i]]+=1
-
-    return heights,profile,n_ground_returns
+    in_range = (bin<n_bins) & (bin>=0) # in case there are some spuriously high returns outside the permitted range
+
+    # consider only first return veg returns for the profile
+    can = first & (C==1) & in_range
+    profile = np.bincount(bin[can],minlength=n_bins).astype('float')
+
+    if not all_returns:
+        return heights,profile,n_ground_returns
+
+    K = int(R.max()) if R.size > 0 else 1
+    n_classes = int(C.max())+1 if C.size > 0 else 1
+    use = (R>=1) & (C>=0)
+    k = R[use].astype(int)-1
+    c = C[use].astype(int)
+    totals = np.bincount(k*n_classes+c,minlength=K*n_classes).reshape(K,n_classes).astype('float')
+    use = use & in_range
+    k = R[use].astype(int)-1
+    c = C[use].astype(int)
+    counts = np.bincount((k*n_classes+c)*n_bins+bin[use],minlength=K*n_classes*n_bins).reshape(K,n_classes,n_bins).astype('float')
+    return heights,profile,n_ground_returns,counts,totals
 
 # Use MacArthur-Horn method to estimate LAD profile from the lidar return profile.  See methods described by Stark et al., Ecology Letters, 2012
 def estimate_LAD_MacArthurHorn(lidar_profile,n_ground_returns,layer_thickness,k):
-    n_layers = lidar_profile.size    
-    S = np.zeros(n_layers+1)
-    S[1:]=np.cumsum(lidar_profile)
-    S+=n_ground_returns
+    LAD_profile = estimate_LAD_MacArthurHorn_batch(lidar_profile.reshape(1,-1),np.asarray([n_ground_returns]),layer_thickness,k)
+    return LAD_profile[0]
+
+# Batched version of the above for a stack of return profiles (n_columns x n_layers, e.g.
+# subplots or grid cells) and a vector of ground return counts (one per column), with
+# the cumulative sums and logs evaluated over the whole array at once.  k can be a
+# single value or one per column.  If minimum_height is given, LAD is set to zero in
+# layers with heights (layer tops) at or below it.
+def estimate_LAD_MacArthurHorn_batch(lidar_profiles,n_ground_returns,layer_thickness,k,minimum_height=None):
+    n_columns,n_layers = lidar_profiles.shape
+    S = np.zeros((n_columns,n_layers+1))
+    S[:,1:]=np.cumsum(lidar_profiles,axis=1)
+    S+=np.asarray(n_ground_returns).reshape(-1,1)
     #S+=(2*n_ground_returns) # Harding et al., 2001 correction to account for the fact that ground reflectance is typically lower than canopy
     S[S==0]=1 # This step is required to stop the base of the profile (final return) kicking out errors if there are no ground returns
-    S_in = S[1:]
-    S_out= S[:-1]
-    LAD_profile = np.log(S_in/S_out)/(k*layer_thickness)
+    S_in = S[:,1:]
+    S_out= S[:,:-1]
+    k = np.asarray(k,dtype='float')
+    if k.ndim > 0:
+        k = k.reshape(-1,1)
+    LAD_profiles = np.log(S_in/S_out)/(k*layer_thickness)
     
     # Shouldn't have any divide by zeros, but just in case...
-    if np.sum(np.isfinite(LAD_profile)==False)>0:
-        print np.sum(np.isfinite(LAD_profile)==False)
-    LAD_profile[np.isfinite(LAD_profile)==False]==0
-
-    return LAD_profile
-
+    if np.sum(np.isfinite(LAD_profiles)==False)>0:
+        print np.sum(np.isfinite(LAD_profiles)==False)
+    LAD_profiles[np.isfinite(LAD_profiles)==False]=0
 
+    if minimum_height is not None:
+        heights = np.arange(1,n_layers+1)*layer_thickness
+        LAD_profiles[:,heights<=minimum_height]=0
+    return LAD_profiles
 
 # Do some crunching to brute force the best fitting k for MacArther-Horn method.
+# LAD from the MacArthur-Horn method scales as 1/k, so the LAI for each k is the LAI for
+# k=1 divided by k, and the misfit for all k values is evaluated in one step.
 def minimise_misfit_for_k(kmin,kmax,k_interval,subplot_LAIs,subplot_lidar_profiles,n_ground_returns,layer_thickness,minimum_height=0):
 
-    n_layers = subplot_lidar_profiles.shape[1]
-    heights = np.arange(1,n_layers+1)*layer_thickness
-    mask = heights<=2
-    # first of all, loop through the k values
     ks = np.arange(kmin,kmax+k_interval,k_interval)
-    n_ks = ks.size
-    misfit = np.zeros(n_ks)
-    misfit_b = np.zeros(n_ks)
     n_subplots = subplot_LAIs.size
-    for i in range(0,n_ks):
-        # now loop through the subplots
-        for j in range(0,n_subplots):
-            LAD_profile = estimate_LAD_MacArthurHorn(subplot_lidar_profiles[j,:],n_ground_returns[j],layer_thickness,ks[i])
-            LAD_profile[mask]=0
-            misfit[i] += np.sqrt((np.sum(LAD_profile)-subplot_LAIs[j])**2)
+    LAI_k1 = np.sum(estimate_LAD_MacArthurHorn_batch(subplot_lidar_profiles,n_ground_returns,layer_thickness,1.,minimum_height=2),axis=1)
+    misfit = np.sum(np.sqrt((LAI_k1.reshape(1,-1)/ks.reshape(-1,1)-subplot_LAIs.reshape(1,-1))**2),axis=1)
     misfit/=float(n_subplots)
-    best_k_LAD_profiles = np.zeros((subplot_lidar_profiles.shape))
     best_k = ks[misfit==np.min(misfit)]
-    for j in range(0,n_subplots):
-        best_k_LAD_profiles[j,:] = estimate_LAD_MacArtherHorn(subplot_lidar_profiles[j,:],n_ground_returns[j],layer_thickness,best_k)
+    best_k_LAD_profiles = estimate_LAD_MacArthurHorn_batch(subplot_lidar_profiles,n_ground_returns,layer_thickness,best_k[0])
     print "Field LAI: ", np.mean(subplot_LAIs), "+/-", np.std(subplot_LAIs),"; LiDAR LAI: ",np.mean(np.sum(best_k_LAD_profiles,axis=1)), "+/-", np.std(np.sum(best_k_LAD_profiles,axis=1)), "; best k: ", best_k, " m-1"
 
     return misfit, ks, best_k_LAD_profiles, best_k
 
+# Closed form calibration of k for the MacArthur-Horn method against field LAI.  The
+# misfit used above (mean absolute difference between field LAI and LiDAR LAI = LAI_k1/k)
+# is piecewise linear and convex in 1/k, and is minimised where 1/k is the median of the
+# ratios field_LAI/LAI_k1, weighted by LAI_k1.  LAI_k1 is the LiDAR LAI for k=1 (e.g. the
+# sum over the profiles from estimate_LAD_MacArthurHorn_batch).  If plot_labels (one per
+# subplot) is given, k is calibrated separately for each plot and a dictionary of k
+# values keyed by plot is returned; otherwise a single k is calibrated over all subplots.
+# The result is limited to the range kmin-kmax (by default the range searched by the
+# drivers).  np.nan is returned when k cannot be calibrated, i.e. when no subplot has
+# both canopy returns and a positive field LAI.
+def calibrate_k_MacArthurHorn(field_LAI,LAI_k1,plot_labels=None,kmin=0.2,kmax=5.):
+    field_LAI = np.asarray(field_LAI,dtype='float')
+    LAI_k1 = np.asarray(LAI_k1,dtype='float')
+    if plot_labels is not None:
+        plot_labels = np.asarray(plot_labels)
+        best_k = {}
+        for plot in np.unique(plot_labels):
+            use = plot_labels==plot
+            best_k[plot] = calibrate_k_MacArthurHorn(field_LAI[use],LAI_k1[use],kmin=kmin,kmax=kmax)
+        return best_k
+
+    # subplots without canopy returns contribute the same misfit for any k
+    use = LAI_k1>0
+    if use.sum() == 0 or np.all(field_LAI[use]<=0):
+        return np.nan
+    ratio = field_LAI[use]/LAI_k1[use]
+    weights = LAI_k1[use]
+    order = np.argsort(ratio)
+    cumulative_weights = np.cumsum(weights[order])
+    u = ratio[order][np.searchsorted(cumulative_weights,0.5*cumulative_weights[-1])]
+    return np.clip(1./u,kmin,kmax) if u > 0 else kmax
 
 def calculate_bestfit_LAD_profile(subplot_coordinate_file,LAI_file,las_file,Plot_name,minimum_height=0):
     subplot_polygons, subplot_labels = aux.load_boundaries(subplot_coordinate_file)
@@ -114,3 +162,68 @@ def estimate_LAD_MacArthurHorn_full(sample_pts,max_height,layer_thickness,minimu
     mask = heights <= minimum_height
     LAD_MacArthurHorn[mask] = 0
     return heights, LAD_MacArthurHorn
+
+# Count first returns on a regular grid of voxel columns in a single pass.  bbox is
+# [xmin,ymin,xmax,ymax] (the extent of the points if not given), divided into square cells
+# of side cell_size; rows of the grid run from south to north (increasing y) and columns
+# from west to east.  Canopy returns are binned vertically as in bin_returns.  The counts
+# are stored in the smallest unsigned integer type that holds them.
+# Returns
+# heights          :: layer tops
+# profiles         :: first return canopy counts (n_rows x n_cols x n_layers)
+# n_ground_returns :: first return ground counts (n_rows x n_cols)
+# x, y             :: coordinates of the cell centres
+def grid_returns(pts, cell_size, max_height, layer_thickness, bbox=None):
+    x = pts[:,0]
+    y = pts[:,1]
+    if bbox is None:
+        bbox = [np.min(x),np.min(y),np.max(x),np.max(y)]
+    n_cols = max(int(np.ceil((bbox[2]-bbox[0])/cell_size)),1)
+    n_rows = max(int(np.ceil((bbox[3]-bbox[1])/cell_size)),1)
+    lower_lims=np.arange(0,max_height,layer_thickness)
+    n_bins = lower_lims.size
+    heights = lower_lims+layer_thickness
+
+    R = pts[:,3]
+    C = pts[:,4]
+    inside = np.all((R==1,x>=bbox[0],x<=bbox[2],y>=bbox[1],y<=bbox[3]),axis=0)
+    col = np.minimum(np.floor((x-bbox[0])/cell_size).astype(int),n_cols-1)
+    row = np.minimum(np.floor((y-bbox[1])/cell_size).astype(int),n_rows-1)
+    cell = row*n_cols+col
+    bin = (pts[:,2]//layer_thickness).astype(int)
+
+    ground = inside & (C==2)
+    can = inside & (C==1) & (bin<n_bins) & (bin>=0)
+    voxels,counts = np.unique(cell[can]*n_bins+bin[can],return_counts=True)
+    profiles = np.zeros(n_rows*n_cols*n_bins,dtype=_count_dtype(counts))
+    profiles[voxels] = counts
+    cells,counts = np.unique(cell[ground],return_counts=True)
+    n_ground_returns = np.zeros(n_rows*n_cols,dtype=_count_dtype(counts))
+    n_ground_returns[cells] = counts
+
+    xc = bbox[0]+(np.arange(n_cols)+0.5)*cell_size
+    yc = bbox[1]+(np.arange(n_rows)+0.5)*cell_size
+    return heights,profiles.reshape(n_rows,n_cols,n_bins),n_ground_returns.reshape(n_rows,n_cols),xc,yc
+
+# smallest unsigned integer type for a set of counts
+def _count_dtype(counts):
+    max_count = counts.max() if counts.size > 0 else 0
+    for dtype in ['uint8','uint16','uint32']:
+        if max_count <= np.iinfo(dtype).max:
+            return dtype
+    return 'uint64'
+
+# Wall-to-wall MacArthur-Horn LAD for a tile or area of interest: first returns are
+# counted on a grid of voxel columns (see grid_returns) and all columns are inverted in
+# one batch.  Returns the layer heights, the LAD cube (n_rows x n_cols x n_layers), the
+# LAI raster (n_rows x n_cols) and the cell centre coordinates.  Cells without any first
+# returns are set to np.nan.
+def grid_LAD_MacArthurHorn(pts, cell_size, max_height, layer_thickness, k=1., minimum_height=2, bbox=None):
+    heights,profiles,n_ground_returns,x,y = grid_returns(pts, cell_size, max_height, layer_thickness, bbox)
+    n_rows,n_cols,n_bins = profiles.shape
+    LAD = estimate_LAD_MacArthurHorn_batch(profiles.reshape(-1,n_bins),n_ground_returns.ravel(),layer_thickness,k,minimum_height)
+    LAD = LAD.reshape(n_rows,n_cols,n_bins)
+    empty = (np.sum(profiles,axis=2)+n_ground_returns)==0
+    LAD[empty,:] = np.nan
+    LAI = np.sum(LAD,axis=2)
+    return heights,LAD,LAI,x,y
@@ -0,0 +1,114 @@
+import numpy as np
+import LiDAR_tools as lidar
+import LiDAR_MacHorn_LAD_profiles as LAD1
+import LiDAR_radiative_transfer_LAD_profiles as LAD2
+
+#----------------------------------------------------------------------------------------
+# Canopy profiles for a set of nested circular neighbourhoods around a single location
+# (e.g. radii of 5, 10, 20 and 40 m around a camera trap).  Rather than clipping and
+# binning the point cloud once for each radius, the points within the largest radius are
+# assigned to the ring (the annulus between consecutive radii) that they fall in, the
+# return histograms are built once per ring, and the histograms for each radius are the
+# cumulative sums over the rings it contains.  The profiles are identical to those from
+# filter_lidar_data_by_neighbourhood followed by estimate_LAD_MacArthurHorn_full and
+# calculate_LAD_rad_DTM_full for each radius.
+#
+# Inputs
+# pts          :: the lidar points (see LiDAR_radiative_transfer_LAD_profiles)
+# target_xy    :: the centre of the neighbourhoods
+# radii        :: the radii of the neighbourhoods
+# other inputs are as for estimate_LAD_MacArthurHorn_full and calculate_LAD_rad_DTM_full
+# Outputs
+# heights      :: heights of the MacArthur-Horn profiles
+# LAD_MH       :: MacArthur-Horn LAD profiles (one row per radius)
+# heights_rad  :: heights of the radiative transfer profiles
+# LAD_rad      :: radiative transfer LAD profiles (one row per radius).  Rows for radii
+#                 that contain no returns are set to np.nan.
+def calculate_nested_LAD_profiles(pts,target_xy,radii,max_height,layer_thickness,minimum_height,max_return,leaf_angle_dist='spherical'):
+    radii = np.asarray(radii,dtype='float')
+    n_radii = radii.size
+    pts = lidar.filter_lidar_data_by_neighbourhood(pts,target_xy,radii.max())
+
+    # assign each point to the smallest radius that contains it (using the same distance
+    # test as points_in_radius)
+    d2 = (pts[:,0]-target_xy[0])**2+(pts[:,1]-target_xy[1])**2
+    radius_order = np.argsort(radii,kind='mergesort')
+    ring = np.searchsorted(radii[radius_order]**2,d2,side='left')
+
+    #---------------------------------------------------------------------
+    # MacArthur-Horn - first return canopy and ground counts per ring
+    lower_lims = np.arange(0,max_height,layer_thickness)
+    heights = lower_lims+layer_thickness
+    n_bins = lower_lims.size
+    first = pts[:,3]==1
+    ground = first & (pts[:,4]==2)
+    canopy = first & (pts[:,4]==1)
+    bin = (pts[:,2]//layer_thickness).astype(int)
+    canopy = canopy & (bin>=0) & (bin<n_bins)
+    profiles = np.bincount(ring[canopy]*n_bins+bin[canopy],minlength=n_radii*n_bins).reshape(n_radii,n_bins)
+    profiles = np.cumsum(profiles,axis=0).astype('float')
+    n_ground_returns = np.cumsum(np.bincount(ring[ground],minlength=n_radii))
+
+    LAD_MH = np.zeros((n_radii,n_bins))
+    mask = heights <= minimum_height
+    for rr in range(0,n_radii):
+        LAD_MH[radius_order[rr],:] = LAD1.estimate_LAD_MacArthurHorn(profiles[rr],n_ground_returns[rr],layer_thickness,1.)
+        LAD_MH[radius_order[rr],mask] = 0
+
+    #---------------------------------------------------------------------
+    # Radiative transfer - return matrix per ring
+    heights_rad = np.arange(0,max_height+1,layer_thickness)
+    M = heights_rad.size
+    dz = np.abs(heights_rad[0]-heights_rad[1])
+    keep = pts[:,3]<=max_return
+    z0 = np.max(heights_rad) - pts[keep,2]
+    R = pts[keep,3].astype(int)
+    veg = pts[keep,4]==1
+    A = np.abs(pts[keep,5]).astype('float')
+    ring = ring[keep]
+    th_all = np.unique(A)
+    S_all = th_all.size
+    K_all = max(R.max(),1) if R.size > 0 else 1
+    angle = np.searchsorted(th_all,A)
+    valid_R = (R>=1) & (R<=K_all)
+    layer = np.searchsorted(heights_rad,z0,side='right')-1
+    in_layer = (layer>=0) & (layer<M)
+    in_layer[in_layer] = z0[in_layer]<heights_rad[layer[in_layer]]+dz
+    in_layer = in_layer & valid_R
+
+    # number of returns for each ring, scan angle and return number (all heights)
+    counts_shape = (n_radii,S_all,K_all)
+    use = valid_R
+    N = np.bincount(np.ravel_multi_index((ring[use],angle[use],R[use]-1),counts_shape),minlength=np.prod(counts_shape)).reshape(counts_shape)
+    use = valid_R & veg
+    N_veg = np.bincount(np.ravel_multi_index((ring[use],angle[use],R[use]-1),counts_shape),minlength=np.prod(counts_shape)).reshape(counts_shape)
+    # points per ring and scan angle, and highest return number per ring, which determine
+    # the scan angles and return numbers that are present within each radius
+    n_angle = np.bincount(ring*S_all+angle,minlength=n_radii*S_all).reshape(n_radii,S_all)
+    max_R = np.zeros(n_radii,dtype=int)
+    if R.size > 0:
+        np.maximum.at(max_R,ring,R)
+    # return matrix for each ring
+    n_shape = (n_radii,M,S_all,K_all)
+    use = in_layer
+    n = np.bincount(np.ravel_multi_index((ring[use],layer[use],angle[use],R[use]-1),n_shape),minlength=np.prod(n_shape)).reshape(n_shape)
+
+    N = np.cumsum(N,axis=0).astype('float')
+    N_veg = np.cumsum(N_veg,axis=0).astype('float')
+    n_angle = np.cumsum(n_angle,axis=0)
+    max_R = np.maximum.accumulate(max_R)
+    n = np.cumsum(n,axis=0).astype('float')
+
+    LAD_rad = np.zeros((n_radii,M))*np.nan
+    mask = heights_rad <= minimum_height
+    for rr in range(0,n_radii):
+        present = n_angle[rr]>0
+        if present.sum() == 0:
+            continue
+        K = int(max_R[rr])
+        th = th_all[present]
+        u,n_rr,I,U = LAD2.calculate_LAD_DTM_from_counts(n[rr][:,present,:K],N[rr][present,:K],N_veg[rr][present,:K],th,heights_rad,leaf_angle_dist)
+        LAD_rad[radius_order[rr],:] = u[::-1]
+        LAD_rad[radius_order[rr],mask] = 0
+
+    return heights, LAD_MH, heights_rad, LAD_rad
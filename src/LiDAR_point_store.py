@@ -0,0 +1,205 @@
+import os
+import numpy as np
+import LiDAR_tools as lidar
+import LiDAR_tile_catalog as tiles
+
+###################################################################################
+# Morton-ordered point store.  This is a one-off conversion of a set of las tiles
+# into columnar shards that are optimised for repeated extraction of areas of
+# interest.  Within each shard the points are sorted by the Morton (Z-order) key of
+# the grid cell they fall in, so that points that are close in space are close on
+# disk.  Each column of a shard is held in its own .npy file and memory mapped on
+# read, and a small index records the key range and extent of every shard.  A
+# query is converted into a short list of Morton key ranges covering its bounding
+# box; these map to contiguous runs of rows in each shard, and only those runs are
+# read before the final exact clip.
+#
+# Store layout (store_dir):
+#   index.npz              store metadata and per-shard key ranges/extents
+#   shard_XXXXX_<col>.npy  one file per column: key, X, Y, Z (int32, on the grid of
+#                          the first tile), return_num, classification, scan_angle
+###################################################################################
+
+# spread the lower 32 bits of an integer array so that there is a zero bit between
+# each bit (the building block for 2D Morton keys)
+def _part1by1(n):
+    n = np.asarray(n).astype('uint64') & np.uint64(0xFFFFFFFF)
+    n = (n | (n << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    n = (n | (n << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    n = (n | (n << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    n = (n | (n << np.uint64(2))) & np.uint64(0x3333333333333333)
+    n = (n | (n << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return n
+
+# Morton key for integer cell coordinates cx, cy (0 <= cx,cy < 2**32)
+def morton_key(cx,cy):
+    return _part1by1(cx) | (_part1by1(cy) << np.uint64(1))
+
+# Decompose the block of cells [cx0,cx1]x[cy0,cy1] into a sorted list of Morton key
+# ranges (inclusive).  The quadtree is descended level by level; once the number of
+# ranges would exceed max_ranges, the remaining partially covered quadrants are
+# returned whole, so the ranges always cover the block but may include a few extra
+# cells (these are removed by the exact clip that follows).
+def morton_ranges(cx0,cy0,cx1,cy1,max_ranges=64):
+    level = max(int(np.ceil(np.log2(max(cx1,cy1)+1))),1)
+    nodes = [(0,0,level)]
+    ranges = []
+    while len(nodes) > 0:
+        partial = []
+        for x,y,l in nodes:
+            size = 1 << l
+            if x > cx1 or y > cy1 or x+size-1 < cx0 or y+size-1 < cy0:
+                continue
+            if (x >= cx0 and y >= cy0 and x+size-1 <= cx1 and y+size-1 <= cy1) or l == 0:
+                ranges.append((x,y,l))
+            else:
+                partial.append((x,y,l))
+        if len(ranges)+4*len(partial) > max_ranges:
+            ranges += partial
+            break
+        half = [(x,y,l-1) for x,y,l in partial]
+        nodes = []
+        for x,y,l in half:
+            size = 1 << l
+            nodes += [(x,y,l),(x+size,y,l),(x,y+size,l),(x+size,y+size,l)]
+
+    # convert quadrants to key ranges and merge those that are contiguous
+    key_ranges = []
+    for x,y,l in ranges:
+        lo = int(morton_key(x,y))
+        key_ranges.append([lo,lo+(1 << (2*l))-1])
+    key_ranges.sort()
+    merged = []
+    for lo,hi in key_ranges:
+        if len(merged) > 0 and lo <= merged[-1][1]+1:
+            merged[-1][1] = max(merged[-1][1],hi)
+        else:
+            merged.append([lo,hi])
+    return merged
+
+# Convert a list of las files into a Morton-ordered point store in store_dir.  Each
+# tile is loaded, sorted and written in turn (so memory use is bounded by the largest
+# tile); tiles with more than max_shard_points points are split into several shards
+# along the Morton order.  cell_size is the resolution (m) of the Morton grid, which
+# sets the granularity of the key ranges used in queries.
+def build_point_store(las_files,store_dir,cell_size=1.,max_shard_points=5000000):
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    # coordinates are stored on the grid (scale and offset) of the first tile; the Morton
+    # grid has its origin at the lower-left corner of the whole collection
+    catalog = tiles.read_tile_headers(las_files)
+    first = lidar.LasPointMap(las_files[0])
+    scale = first.scale
+    offset = first.offset
+    origin = np.floor(np.min(catalog['min'][:,:2],axis=0))
+
+    shard_files = []
+    key_min = []
+    key_max = []
+    bbox = []
+    n_points = []
+    for las_file in las_files:
+        pts = lidar.load_lidar_data(las_file,compact=True)
+        x = pts.column(0)
+        y = pts.column(1)
+        keys = morton_key(np.floor((x-origin[0])/cell_size),np.floor((y-origin[1])/cell_size))
+        order = np.argsort(keys,kind='mergesort')
+        keys = keys[order]
+        records = lidar.regrid_points(pts.subset(order),scale,offset).records
+        x = x[order]
+        y = y[order]
+        for start in range(0,keys.size,max_shard_points):
+            rows = slice(start,min(start+max_shard_points,keys.size))
+            name = 'shard_%05i' % len(shard_files)
+            np.save(os.path.join(store_dir,name+'_key.npy'),keys[rows])
+            for col in lidar.compact_point_dtype.names:
+                np.save(os.path.join(store_dir,name+'_'+col+'.npy'),np.ascontiguousarray(records[col][rows]))
+            shard_files.append(name)
+            key_min.append(keys[rows][0])
+            key_max.append(keys[rows][-1])
+            bbox.append([x[rows].min(),y[rows].min(),x[rows].max(),y[rows].max()])
+            n_points.append(keys[rows].size)
+
+    np.savez(os.path.join(store_dir,'index.npz'),shards=np.asarray(shard_files,dtype='S64'),
+             key_min=np.asarray(key_min,dtype='uint64'),key_max=np.asarray(key_max,dtype='uint64'),
+             bbox=np.asarray(bbox).reshape(-1,4),n_points=np.asarray(n_points,dtype='int64'),
+             scale=scale,offset=offset,origin=origin,cell_size=cell_size)
+    return MortonPointStore(store_dir)
+
+# Read access to a store written by build_point_store
+class MortonPointStore(object):
+
+    def __init__(self,store_dir):
+        self.store_dir = store_dir
+        index = np.load(os.path.join(store_dir,'index.npz'))
+        self.shards = index['shards']
+        self.key_min = index['key_min']
+        self.key_max = index['key_max']
+        self.bbox = index['bbox']
+        self.n_points = index['n_points']
+        self.scale = index['scale']
+        self.offset = index['offset']
+        self.origin = index['origin']
+        self.cell_size = float(index['cell_size'])
+        index.close()
+
+    # memory map one column of a shard
+    def _column(self,shard,col):
+        return np.load(os.path.join(self.store_dir,self.shards[shard]+'_'+col+'.npy'),mmap_mode='r')
+
+    # cell coordinates on the Morton grid, limited to the valid key range
+    def _cell(self,x,y):
+        cx = np.floor((x-self.origin[0])/self.cell_size)
+        cy = np.floor((y-self.origin[1])/self.cell_size)
+        return int(np.clip(cx,0,2**32-1)), int(np.clip(cy,0,2**32-1))
+
+    # All points in the store within bbox ([xmin,ymin,xmax,ymax]) as a CompactPointCloud.
+    # Only the runs of rows whose keys fall in the covering key ranges are read.
+    def _read_bbox(self,bbox,max_ranges=64):
+        cx0,cy0 = self._cell(bbox[0],bbox[1])
+        cx1,cy1 = self._cell(bbox[2],bbox[3])
+        ranges = np.asarray(morton_ranges(cx0,cy0,cx1,cy1,max_ranges),dtype='uint64').reshape(-1,2)
+        blocks = []
+        for ss in range(0,self.shards.size):
+            if self.bbox[ss,0] > bbox[2] or self.bbox[ss,2] < bbox[0] or self.bbox[ss,1] > bbox[3] or self.bbox[ss,3] < bbox[1]:
+                continue
+            use = np.all((ranges[:,0]<=self.key_max[ss],ranges[:,1]>=self.key_min[ss]),axis=0)
+            if use.sum() == 0:
+                continue
+            keys = self._column(ss,'key')
+            starts = np.searchsorted(keys,ranges[use,0],side='left')
+            stops = np.searchsorted(keys,ranges[use,1],side='right')
+            rows = np.concatenate([np.arange(a,b) for a,b in zip(starts,stops)])
+            if rows.size == 0:
+                continue
+            records = np.zeros(rows.size,dtype=lidar.compact_point_dtype)
+            for col in lidar.compact_point_dtype.names:
+                column = self._column(ss,col)
+                records[col] = np.concatenate([column[a:b] for a,b in zip(starts,stops)])
+            blocks.append(lidar.CompactPointCloud(records,self.scale,self.offset))
+        if len(blocks) == 0:
+            return lidar.CompactPointCloud(np.zeros(0,dtype=lidar.compact_point_dtype),self.scale,self.offset)
+        return lidar.concatenate_points(blocks)
+
+    # return points as a CompactPointCloud if compact, otherwise the standard Nx6 array
+    def _output(self,pts,compact):
+        if compact:
+            return pts
+        return pts.to_array()
+
+    def query_bbox(self,bbox,compact=False):
+        pts = self._read_bbox(bbox)
+        x = pts.column(0)
+        y = pts.column(1)
+        inside = np.all((x>=bbox[0],x<=bbox[2],y>=bbox[1],y<=bbox[3]),axis=0)
+        return self._output(pts.subset(inside),compact)
+
+    def query_polygon(self,polygon,compact=False):
+        bbox = [np.min(polygon[:,0]),np.min(polygon[:,1]),np.max(polygon[:,0]),np.max(polygon[:,1])]
+        pts = lidar.filter_lidar_data_by_polygon(self._read_bbox(bbox),polygon)
+        return self._output(pts,compact)
+
+    def query_neighbourhood(self,xy,radius,compact=False):
+        bbox = [xy[0]-radius,xy[1]-radius,xy[0]+radius,xy[1]+radius]
+        pts = lidar.filter_lidar_data_by_neighbourhood(self._read_bbox(bbox),xy,radius)
+        return self._output(pts,compact)
@@ -12,6 +12,7 @@ import numpy as np
 # Inputs
 # pts :: a vector containing the lidar points.  This will have the following structure:
 #            - x, y, z, k, c, A (where k=return number, c=classification, A=scan angle
+#        This can also be a LiDAR_tools.CompactPointCloud.
 # zi  :: a vector containing the heights at which LAD will be estimated.
 # tl  :: leaf inclination model ('planophile'.'erectophile','spherical')
 # n   :: a matrix with the dimensions M(number of layers)
@@ -35,7 +36,7 @@ def calculate_LAD_Detto_original(pts,zi,max_k,tl,n=np.array([])):
     keep = pts[:,3]<=max_k
     z0 = np.max(zi) - pts[keep,2]
     R  = pts[keep,3]
-    A  = np.abs(pts[keep,5])
+    A  = np.abs(pts[keep,5]).astype('float')
     # define other variables
     dz = np.abs(zi[0]-zi[1])
     M  = zi.size
@@ -128,7 +129,7 @@ def calculate_LAD(pts,zi,max_k,tl,n=np.array([])):
     keep = pts[:,3]<=max_k
     z0 = np.max(zi) - pts[keep,2]
     R  = pts[keep,3]
-    A  = np.abs(pts[keep,5])
+    A  = np.abs(pts[keep,5]).astype('float')
     # define other variables
     dz = np.abs(zi[0]-zi[1])
     M  = zi.size
@@ -168,6 +169,18 @@ def calculate_LAD(pts,zi,max_k,tl,n=np.array([])):
                 for k in range(0,K):
                     n[i,j,k]=np.sum(R[use1][use2]==k+1) # check conditional indexing - should be ok        
 
+    return calculate_LAD_from_return_matrix(n,th,zi,tl)
+
+# The inversion step of calculate_LAD, starting from the return matrix n (dimensions MxSxK
+# as described above) and the scan angles th that make up its second dimension.  This allows
+# LAD to be estimated from return counts that have been accumulated without the points to
+# hand.
+def calculate_LAD_from_return_matrix(n,th,zi,tl):
+    dz = np.abs(zi[0]-zi[1])
+    M  = zi.size
+    S  = th.size
+    K  = n.shape[2]
+
     ##### New test -> let's add 1 to all 1st return bins for which there are also other returns
     for s in range(0,S):
         n1_test=np.sum(n[:,s,:],axis=1)   # this replicates code used in loop below for calculating penetration functions
@@ -301,7 +314,7 @@ def calculate_LAD_DTM(pts,zi,max_k,tl):
     z0 = np.max(zi) - pts[keep,2]
     R  = pts[keep,3]
     Class  = pts[keep,4]
-    A  = np.abs(pts[keep,5])
+    A  = np.abs(pts[keep,5]).astype('float')
     # define other variables
     dz = np.abs(zi[0]-zi[1])
     M  = zi.size
@@ -320,6 +333,40 @@ def calculate_LAD_DTM(pts,zi,max_k,tl):
             for k in range(0,K):
                 n[i,j,k]=np.sum(R[use1][use2]==k+1) # check conditional indexing - should be ok
 
+    # number of returns (N) and vegetation returns (N_veg) for each scan angle and return
+    # number
+    N = np.zeros((S,K))
+    N_veg = np.zeros((S,K))
+    for s in range(0,S):
+        for k in range(0,K):
+            N[s,k] = float(np.all((R==k+1,A==th[s]),axis=0).sum())
+            N_veg[s,k] = float(np.all((R==k+1,Class==1,A==th[s]),axis=0).sum())
+    n = correct_return_matrix(n,N,N_veg)
+
+    u,n,I,U = calculate_LAD(pts,zi,max_k,tl,n)
+    
+    return u,n,I,U
+
+# The calculate_LAD_DTM scheme, starting from return counts rather than points: n is the
+# uncorrected return matrix (MxSxK), N and N_veg the total and vegetation returns for each
+# scan angle and return number (SxK, see correct_return_matrix) and th the scan angles.
+def calculate_LAD_DTM_from_counts(n,N,N_veg,th,zi,tl):
+    n_raw = n
+    n = correct_return_matrix(n_raw.copy(),N,N_veg)
+    # as in calculate_LAD, scan angles without first returns are dropped, and the
+    # uncorrected return matrix is used in this case
+    n0_test = np.sum(n[:,:,0],axis=0)
+    if np.sum(n0_test==0)>0:
+        th = th[n0_test>0]
+        n = n_raw[:,n0_test>0,:].copy()
+    return calculate_LAD_from_return_matrix(n,th,zi,tl)
+
+# Apply the return number correction used in calculate_LAD_DTM to the return matrix n.  N and
+# N_veg are SxK matrices holding the total number of returns and the number of vegetation
+# returns for each scan angle and return number.
+def correct_return_matrix(n,N,N_veg):
+    S = n.shape[1]
+    K = n.shape[2]
     #derive correction factor for different return numbers for each scan angle
     #CF = np.zeros(K)
     CF = np.zeros((S,K))
@@ -331,8 +378,8 @@ def calculate_LAD_DTM(pts,zi,max_k,tl):
             N_veg_kprev = float(np.all((pts[:,3]==this_k-1,pts[:,4]==1),axis=0).sum())
             N_k = float((pts[:,3]==this_k).sum())
             """
-            N_veg_kprev = float(np.all((R==this_k-1,Class==1,A==th[s]),axis=0).sum())
-            N_k = float(np.all((R==this_k,A==th[s]),axis=0).sum())
+            N_veg_kprev = N_veg[s,k-1]
+            N_k = N[s,k]
             # in the case where there are no returns at return number = k for scan angle s
             # we have no information about vegetation and therefore cannot make a correction
             # This is likely to be rare, and possible future fixes could include exclusion
@@ -342,10 +389,7 @@ def calculate_LAD_DTM(pts,zi,max_k,tl):
             else:
                 CF[s,k]=N_veg_kprev/N_k
             n[:,s,k]*=np.product(CF[s,:this_k])
-
-    u,n,I,U = calculate_LAD(pts,zi,max_k,tl,n)
-    
-    return u,n,I,U
+    return n
 
 
 
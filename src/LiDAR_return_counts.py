@@ -0,0 +1,216 @@
+import numpy as np
+import LiDAR_MacHorn_LAD_profiles as LAD1
+import LiDAR_radiative_transfer_LAD_profiles as LAD2
+
+#----------------------------------------------------------------------------------------
+# Streaming return counts for canopy profiling of areas that are too large to hold in
+# memory.  A ReturnCountAccumulator covers a regular grid of square cells (as for
+# LiDAR_MacHorn_LAD_profiles.grid_returns) and counts returns by cell, height layer,
+# return number, classification and scan angle.  Point chunks from any of the loaders in
+# LiDAR_tools are added one at a time, and accumulators built by separate workers (e.g.
+# one per tile) are combined exactly by adding their counts.  MacArthur-Horn and
+# radiative transfer LAD profiles are then estimated from the counts alone.
+#
+# Layers are half-open height bins [j*layer_thickness,(j+1)*layer_thickness), kept
+# separately over a window from one radiative transfer height range below the ground to
+# two above it; all other heights share one extra layer, so that counts over all heights
+# are kept.  Returns lying exactly on a layer boundary are flagged: bin_returns bins
+# heights upwards (the boundary belongs to the layer above) but calculate_LAD_DTM bins
+# them downwards from the top of the canopy (the boundary belongs to the layer below), and
+# the flag allows both to be reproduced, so the profiles are identical to those from the
+# points.  Scan angles are counted as whole degrees.  max_height should be a whole
+# multiple of layer_thickness.
+#
+# The accumulator also acts as a multi-resolution store of vertical counts: coarsen
+# sums adjacent layers to give the counts for any whole multiple of the layer thickness
+# (e.g. 1 m and 2 m profiles from counts at 0.25 m), which are the same as counting the
+# points at the coarser thickness directly (barring heights within rounding error of a
+# layer boundary).
+#
+# The counts are held sparsely, as sorted arrays of voxel keys and counts, so memory
+# scales with the number of occupied (cell, layer, return, class, scan angle) bins
+# rather than with the number of points.
+#----------------------------------------------------------------------------------------
+n_boundary_flags = 2
+n_return_numbers = 16
+n_classes = 256
+n_scan_angles = 128
+
+class ReturnCountAccumulator(object):
+
+    # If cell_size is None, the whole of bbox is a single cell.
+    def __init__(self,bbox,cell_size,max_height,layer_thickness):
+        self.bbox = np.asarray(bbox,dtype='float')
+        self.cell_size = cell_size
+        self.max_height = max_height
+        self.layer_thickness = float(layer_thickness)
+        if cell_size is None:
+            self.n_cols = 1
+            self.n_rows = 1
+        else:
+            self.n_cols = max(int(np.ceil((self.bbox[2]-self.bbox[0])/cell_size)),1)
+            self.n_rows = max(int(np.ceil((self.bbox[3]-self.bbox[1])/cell_size)),1)
+        # the radiative transfer heights span n_top layers; layers j=-n_below ... n_above-1
+        # are stored at j+n_below, and n_below+n_above holds all other heights
+        self.n_top = np.arange(0,max_height+1,layer_thickness).size-1
+        self.n_below = self.n_top+1
+        self.n_above = 2*(self.n_top+1)
+        self.n_layers = self.n_below+self.n_above+1
+        self.keys = np.zeros(0,dtype='int64')
+        self.counts = np.zeros(0,dtype='int64')
+
+    # voxel keys for cell, layer, boundary flag, return number, class and scan angle indices
+    def _key(self,cell,layer,B,R,C,A):
+        return ((((cell*self.n_layers+layer)*n_boundary_flags+B)*n_return_numbers+R)*n_classes+C)*n_scan_angles+A
+
+    # unpack voxel keys into cell, layer, boundary flag, return number, class and scan
+    # angle indices
+    def _unkey(self,keys):
+        keys,A = np.divmod(keys,n_scan_angles)
+        keys,C = np.divmod(keys,n_classes)
+        keys,R = np.divmod(keys,n_return_numbers)
+        keys,B = np.divmod(keys,n_boundary_flags)
+        cell,layer = np.divmod(keys,self.n_layers)
+        return cell,layer,B,R,C,A
+
+    # stored layer index for layers j, with those outside the window in the extra layer
+    def _layer(self,j):
+        layer = j+self.n_below
+        layer[(j<-self.n_below)|(j>=self.n_above)] = self.n_below+self.n_above
+        return layer
+
+    # cell index for points at x,y (assumed to be within bbox)
+    def _cell(self,x,y):
+        if self.cell_size is None:
+            return np.zeros(x.size,dtype='int64')
+        col = np.minimum(np.floor((x-self.bbox[0])/self.cell_size).astype('int64'),self.n_cols-1)
+        row = np.minimum(np.floor((y-self.bbox[1])/self.cell_size).astype('int64'),self.n_rows-1)
+        return row*self.n_cols+col
+
+    # add the counts in (keys, counts) to the accumulator.  keys must be sorted and unique;
+    # they are merged into the stored keys with a binary search rather than a full
+    # re-sort, but inserting new keys still copies the stored key and count arrays, so
+    # each chunk costs time in proportion to the number of keys stored so far.
+    def _add_counts(self,keys,counts):
+        pos = np.searchsorted(self.keys,keys)
+        found = pos<self.keys.size
+        found[found] = self.keys[pos[found]]==keys[found]
+        self.counts[pos[found]] += counts[found]
+        new = ~found
+        self.keys = np.insert(self.keys,pos[new],keys[new])
+        self.counts = np.insert(self.counts,pos[new],counts[new].astype('int64'))
+
+    # add a chunk of points (any of the point array types in LiDAR_tools).  Points outside
+    # the grid are ignored.
+    def add(self,pts):
+        x = pts[:,0]
+        y = pts[:,1]
+        inside = np.all((x>=self.bbox[0],x<=self.bbox[2],y>=self.bbox[1],y<=self.bbox[3]),axis=0)
+        z = pts[:,2][inside]
+        j = z//self.layer_thickness
+        B = (z==j*self.layer_thickness).astype('int64')
+        j = np.clip(j,-self.n_below-1,self.n_above).astype('int64')
+        R = np.clip(pts[:,3][inside],0,n_return_numbers-1).astype('int64')
+        C = np.clip(pts[:,4][inside],0,n_classes-1).astype('int64')
+        A = np.clip(np.abs(pts[:,5][inside]),0,n_scan_angles-1).astype('int64')
+        keys,counts = np.unique(self._key(self._cell(x[inside],y[inside]),self._layer(j),B,R,C,A),return_counts=True)
+        self._add_counts(keys,counts)
+        return self
+
+    # add the counts of another accumulator on the same grid
+    def merge(self,other):
+        if not (np.array_equal(self.bbox,other.bbox) and self.cell_size==other.cell_size and self.max_height==other.max_height and
+                self.n_layers==other.n_layers and self.layer_thickness==other.layer_thickness):
+            raise ValueError('accumulators must have the same grid and layers to be merged')
+        self._add_counts(other.keys,other.counts)
+        return self
+
+    def __add__(self,other):
+        total = ReturnCountAccumulator(self.bbox,self.cell_size,self.max_height,self.layer_thickness)
+        total.merge(self)
+        total.merge(other)
+        return total
+
+    # Counts for layers that are factor (a positive whole number) times thicker, found by
+    # summing adjacent layers
+    def coarsen(self,factor):
+        if int(round(factor)) != factor or factor < 1:
+            raise ValueError('coarsening factor must be a positive whole number')
+        factor = int(round(factor))
+        coarse = ReturnCountAccumulator(self.bbox,self.cell_size,self.max_height,self.layer_thickness*factor)
+        cell,layer,B,R,C,A = self._unkey(self.keys)
+        j = layer-self.n_below
+        outside = layer==self.n_below+self.n_above
+        # a boundary between fine layers is only a coarse boundary every factor layers
+        B = B*(j%factor==0)
+        j = j//factor
+        j[outside] = coarse.n_above
+        keys,inverse = np.unique(coarse._key(cell,coarse._layer(j),B,R,C,A),return_inverse=True)
+        coarse._add_counts(keys,np.bincount(inverse,weights=self.counts,minlength=keys.size).astype('int64'))
+        return coarse
+
+    # first return canopy profiles and ground counts for every cell, as for grid_returns
+    def first_return_profiles(self):
+        lower_lims = np.arange(0,self.max_height,self.layer_thickness)
+        n_bins = lower_lims.size
+        heights = lower_lims+self.layer_thickness
+        cell,layer,B,R,C,A = self._unkey(self.keys)
+        n_cells = self.n_rows*self.n_cols
+        j = layer-self.n_below
+        can = (R==1) & (C==1) & (j>=0) & (j<n_bins)
+        profiles = np.bincount(cell[can]*n_bins+j[can],weights=self.counts[can],minlength=n_cells*n_bins)
+        ground = (R==1) & (C==2)
+        n_ground_returns = np.bincount(cell[ground],weights=self.counts[ground],minlength=n_cells)
+        return heights,profiles.reshape(self.n_rows,self.n_cols,n_bins),n_ground_returns.reshape(self.n_rows,self.n_cols)
+
+    # MacArthur-Horn LAD cube and LAI raster, as for grid_LAD_MacArthurHorn (minimum_height
+    # can be None to keep the lowest layers)
+    def LAD_MacArthurHorn(self,k=1.,minimum_height=2):
+        heights,profiles,n_ground_returns = self.first_return_profiles()
+        n_bins = heights.size
+        LAD = LAD1.estimate_LAD_MacArthurHorn_batch(profiles.reshape(-1,n_bins),n_ground_returns.ravel(),self.layer_thickness,k,minimum_height)
+        LAD = LAD.reshape(self.n_rows,self.n_cols,n_bins)
+        empty = (np.sum(profiles,axis=2)+n_ground_returns)==0
+        LAD[empty,:] = np.nan
+        LAI = np.sum(LAD,axis=2)
+        return heights,LAD,LAI
+
+    # radiative transfer LAD profile (as for calculate_LAD_rad_DTM_full) from the returns in
+    # the cells selected by cells (a boolean n_rows x n_cols array; all cells if None).
+    # Returns np.nan if there are no returns in the selected cells.  If minimum_height is
+    # None, the lowest layers are not set to zero.
+    def LAD_radiative_transfer(self,max_return,minimum_height=2,leaf_angle_dist='spherical',cells=None):
+        heights = np.arange(0,self.max_height+1,self.layer_thickness)
+        M = heights.size
+        cell,layer,B,R,C,A = self._unkey(self.keys)
+        keep = R<=max_return
+        if cells is not None:
+            keep = keep & np.asarray(cells).ravel()[cell]
+        if keep.sum() == 0:
+            return heights,np.zeros(M)*np.nan
+        R = R[keep]
+        C = C[keep]
+        A = A[keep]
+        # layer j in the downward binning (boundaries belong to the layer below)
+        outside = layer[keep]==self.n_below+self.n_above
+        j = layer[keep]-self.n_below-B[keep]
+        counts = self.counts[keep].astype('float')
+
+        th = np.unique(A).astype('float')
+        S = th.size
+        K = int(R.max())
+        angle = np.searchsorted(th,A)
+        valid_R = R>=1
+        N = np.bincount(angle[valid_R]*K+R[valid_R]-1,weights=counts[valid_R],minlength=S*K).reshape(S,K)
+        use = valid_R & (C==1)
+        N_veg = np.bincount(angle[use]*K+R[use]-1,weights=counts[use],minlength=S*K).reshape(S,K)
+        # layer j is depth layer M-2-j below the top of the height range
+        use = valid_R & ~outside & (j>=-1) & (j<=M-2)
+        depth = M-2-j[use]
+        n = np.bincount((depth*S+angle[use])*K+R[use]-1,weights=counts[use],minlength=M*S*K).reshape(M,S,K)
+
+        u,n,I,U = LAD2.calculate_LAD_DTM_from_counts(n,N,N_veg,th,heights,leaf_angle_dist)
+        LAD_rad = u[::-1]
+        if minimum_height is not None:
+            LAD_rad[heights<=minimum_height] = 0
+        return heights,LAD_rad
@@ -0,0 +1,341 @@
+import os
+import numpy as np
+import laspy as las
+from multiprocessing.pool import ThreadPool
+
+###################################################################################
+# Tile catalogue for collections of las tiles.  Finding the tiles that overlap an
+# area of interest needs only the header of each tile (bounding box and number of
+# points), so rather than reopening every file in the list for every query, the
+# headers are read once and stored in a sidecar .npz file alongside the file list.
+# Each entry records the modification time and size of its tile, so that tiles that
+# have changed since the catalogue was built are re-read automatically.
+###################################################################################
+
+# catalogues already loaded in this process, keyed by file list
+_catalogs = {}
+
+# sidecar file in which the catalogue for a given file list is stored
+def tile_catalog_file(file_list):
+    return file_list + '.catalog.npz'
+
+# read the list of las files (full or relative paths, one per line)
+def read_file_list(file_list):
+    las_files = np.genfromtxt(file_list,delimiter=',',dtype='S256')
+    return np.atleast_1d(las_files)
+
+# modification time and size of a file, used to spot tiles that have changed
+def file_signature(las_file):
+    stat = os.stat(las_file)
+    return stat.st_mtime, stat.st_size
+
+# read the bounding box and number of points from the header of a las file
+def read_tile_header(las_file):
+    lasFile = las.file.File(las_file,mode='r')
+    header = lasFile.header
+    min_xyz = np.asarray(header.min,dtype='float')
+    max_xyz = np.asarray(header.max,dtype='float')
+    n_points = header.point_records_count
+    lasFile.close()
+    mtime,size = file_signature(las_file)
+    return min_xyz, max_xyz, n_points, mtime, size
+
+# set up an empty catalogue for a list of files
+def _empty_catalog(las_files):
+    n_files = len(las_files)
+    catalog = {}
+    catalog['files'] = np.asarray(las_files,dtype='S256')
+    catalog['min'] = np.zeros((n_files,3))
+    catalog['max'] = np.zeros((n_files,3))
+    catalog['n_points'] = np.zeros(n_files,dtype='int64')
+    catalog['mtime'] = np.zeros(n_files)
+    catalog['size'] = np.zeros(n_files,dtype='int64')
+    return catalog
+
+# read the headers for a list of files using a pool of n_workers threads (the work is
+# almost entirely file opening, so threads are sufficient)
+def read_tile_headers(las_files,n_workers=8):
+    n_files = len(las_files)
+    catalog = _empty_catalog(las_files)
+    if n_files == 0:
+        return catalog
+    if n_workers > 1 and n_files > 1:
+        pool = ThreadPool(min(n_workers,n_files))
+        headers = pool.map(read_tile_header,las_files)
+        pool.close()
+        pool.join()
+    else:
+        headers = [read_tile_header(las_file) for las_file in las_files]
+    for i in range(0,n_files):
+        catalog['min'][i],catalog['max'][i],catalog['n_points'][i],catalog['mtime'][i],catalog['size'][i] = headers[i]
+    return catalog
+
+# build the catalogue for a file list from scratch and write it to the sidecar file
+def build_tile_catalog(file_list,n_workers=8):
+    catalog = read_tile_headers(read_file_list(file_list),n_workers)
+    save_tile_catalog(file_list,catalog)
+    _catalogs[file_list] = catalog
+    return catalog
+
+def save_tile_catalog(file_list,catalog):
+    try:
+        np.savez(tile_catalog_file(file_list),**catalog)
+    except (IOError,OSError):
+        print 'WARNING: unable to write tile catalogue for', file_list
+
+# Get the catalogue for a file list.  The sidecar file is loaded if present and
+# checked against the file list and the current modification time and size of each
+# tile; any new or changed tiles are re-read (in parallel) and the sidecar is updated.
+# This check is made the first time the catalogue is used in a process; after that the
+# catalogue is served from memory without touching the file system, unless refresh is
+# set (e.g. after tiles have been added or reprocessed).
+def load_tile_catalog(file_list,n_workers=8,refresh=False):
+    catalog = _catalogs.get(file_list)
+    if catalog is not None and not refresh:
+        return catalog
+    las_files = read_file_list(file_list)
+    if catalog is None and os.path.isfile(tile_catalog_file(file_list)):
+        npz = np.load(tile_catalog_file(file_list))
+        catalog = {}
+        for key in npz.files:
+            catalog[key] = npz[key]
+        npz.close()
+    if catalog is None:
+        return build_tile_catalog(file_list,n_workers)
+
+    # match entries in the old catalogue to the current file list
+    lookup = dict(zip(catalog['files'],range(0,catalog['files'].size)))
+    n_files = las_files.size
+    index = np.zeros(n_files,dtype='int64')-1
+    stale = np.zeros(n_files,dtype='bool')
+    for i in range(0,n_files):
+        if las_files[i] in lookup:
+            index[i] = lookup[las_files[i]]
+            mtime,size = file_signature(las_files[i])
+            stale[i] = mtime != catalog['mtime'][index[i]] or size != catalog['size'][index[i]]
+        else:
+            stale[i] = True
+
+    if np.all(index==np.arange(n_files)) and n_files == catalog['files'].size and stale.sum()==0:
+        _catalogs[file_list] = catalog
+        return catalog
+
+    updated = _empty_catalog(las_files)
+    fresh = read_tile_headers(las_files[stale],n_workers)
+    for key in updated.keys():
+        if key == 'files':
+            continue
+        updated[key][~stale] = catalog[key][index[~stale]]
+        updated[key][stale] = fresh[key]
+    save_tile_catalog(file_list,updated)
+    _catalogs[file_list] = updated
+    return updated
+
+###################################################################################
+# Spatial index over tile extents.  TileRTree is a static R-tree, bulk loaded with
+# the Sort-Tile-Recursive (STR) packing algorithm (Leutenegger et al., 1997).  Each
+# level of the tree is held as arrays of node bounding boxes plus the range of
+# children each node covers in the level below, so queries are answered level by
+# level with vectorised box tests.  Batches of queries are processed together by
+# carrying an array of (query, node) pairs down the tree.
+###################################################################################
+class TileRTree(object):
+
+    # mins and maxs are (n,2) arrays with the lower-left and upper-right corners of
+    # each tile; node_capacity is the maximum number of children per node
+    def __init__(self,mins,maxs,node_capacity=16):
+        mins = np.asarray(mins,dtype='float').reshape(-1,2)
+        maxs = np.asarray(maxs,dtype='float').reshape(-1,2)
+        self.node_capacity = node_capacity
+        self.n_tiles = mins.shape[0]
+        self.tile_min = mins
+        self.tile_max = maxs
+        order = self._str_order((mins+maxs)/2.)
+        self.order = order # tile index of each leaf entry
+        self.level_min = [mins[order]]
+        self.level_max = [maxs[order]]
+        self.level_start = [None]
+        self.level_count = [None]
+        # pack successive levels until a single root node remains.  Only the leaves are
+        # STR sorted; each level above groups consecutive nodes of the level below, which
+        # are already in slab order.
+        while self.level_min[-1].shape[0] > 1:
+            child_min = self.level_min[-1]
+            child_max = self.level_max[-1]
+            n_children = child_min.shape[0]
+            start = np.arange(0,n_children,node_capacity)
+            count = np.minimum(node_capacity,n_children-start)
+            self.level_min.append(np.minimum.reduceat(child_min,start,axis=0))
+            self.level_max.append(np.maximum.reduceat(child_max,start,axis=0))
+            self.level_start.append(start)
+            self.level_count.append(count)
+
+    # STR ordering: sort by x, cut into vertical slabs and sort each slab by y, so that
+    # consecutive runs of node_capacity entries are spatially compact
+    def _str_order(self,centres):
+        n = centres.shape[0]
+        n_nodes = int(np.ceil(n/float(self.node_capacity)))
+        n_slabs = max(int(np.ceil(np.sqrt(n_nodes))),1)
+        slab_size = n_slabs*self.node_capacity
+        order = np.argsort(centres[:,0],kind='mergesort')
+        for start in range(0,n,slab_size):
+            slab = order[start:start+slab_size]
+            order[start:start+slab_size] = slab[np.argsort(centres[slab,1],kind='mergesort')]
+        return order
+
+    # Find the tiles whose extents overlap each of a batch of query boxes (arrays of
+    # lower-left and upper-right corners, shape (m,2)).  Returns matching (query, tile)
+    # index pairs as two arrays.
+    def query_bbox_pairs(self,qmins,qmaxs):
+        qmins = np.asarray(qmins,dtype='float').reshape(-1,2)
+        qmaxs = np.asarray(qmaxs,dtype='float').reshape(-1,2)
+        if self.n_tiles == 0:
+            return np.zeros(0,dtype='int64'), np.zeros(0,dtype='int64')
+        top = len(self.level_min)-1
+        n_top = self.level_min[top].shape[0]
+        query = np.repeat(np.arange(qmins.shape[0]),n_top)
+        node = np.tile(np.arange(n_top),qmins.shape[0])
+        for level in range(top,-1,-1):
+            overlap = np.all((self.level_min[level][node]<=qmaxs[query]) & (self.level_max[level][node]>=qmins[query]),axis=1)
+            query = query[overlap]
+            node = node[overlap]
+            if level > 0:
+                # expand each surviving node into its children
+                count = self.level_count[level][node]
+                query = np.repeat(query,count)
+                first = np.repeat(self.level_start[level][node]-(np.cumsum(count)-count),count)
+                node = first+np.arange(count.sum())
+        return query, self.order[node]
+
+    # as query_bbox_pairs, but returning a list with the matching tile indices (sorted)
+    # for each query
+    def query_bbox(self,qmins,qmaxs):
+        qmins = np.asarray(qmins,dtype='float').reshape(-1,2)
+        query,tile = self.query_bbox_pairs(qmins,qmaxs)
+        return _split_pairs(query,tile,qmins.shape[0])
+
+    # tiles intersecting each of a batch of circles (centres xy (m,2), radii (m,) or scalar)
+    def query_radius(self,xy,radius):
+        xy = np.asarray(xy,dtype='float').reshape(-1,2)
+        radius = np.zeros(xy.shape[0])+radius
+        query,tile = self.query_bbox_pairs(xy-radius[:,None],xy+radius[:,None])
+        # refine with the distance from the circle centre to the nearest point of the tile
+        d = np.maximum(np.maximum(self.tile_min[tile]-xy[query],xy[query]-self.tile_max[tile]),0)
+        keep = np.sum(d**2,axis=1) <= radius[query]**2
+        return _split_pairs(query[keep],tile[keep],xy.shape[0])
+
+    # candidate tiles for each of a list of polygons (each an (n,2) vertex array): those
+    # whose extents overlap the polygon's bounding box
+    def query_polygon(self,polygons):
+        qmins = np.asarray([np.min(poly,axis=0) for poly in polygons])
+        qmaxs = np.asarray([np.max(poly,axis=0) for poly in polygons])
+        return self.query_bbox(qmins,qmaxs)
+
+# split arrays of (query, tile) pairs into a list of sorted tile indices per query
+def _split_pairs(query,tile,n_queries):
+    order = np.lexsort((tile,query))
+    query = query[order]
+    tile = tile[order]
+    bounds = np.searchsorted(query,np.arange(n_queries+1))
+    return [tile[bounds[i]:bounds[i+1]] for i in range(0,n_queries)]
+
+# spatial indices already built in this process, keyed by file list
+_rtrees = {}
+
+# get the spatial index for the tiles in a file list, rebuilding it if the catalogue
+# has been refreshed since the index was built
+def load_tile_rtree(file_list,n_workers=8,refresh=False):
+    catalog = load_tile_catalog(file_list,n_workers,refresh)
+    if file_list in _rtrees and _rtrees[file_list][0] is catalog:
+        return catalog, _rtrees[file_list][1]
+    rtree = TileRTree(catalog['min'][:,:2],catalog['max'][:,:2])
+    _rtrees[file_list] = (catalog,rtree)
+    return catalog, rtree
+
+###################################################################################
+# Per-tile cell index sidecars (similar in spirit to LAStools' .lax files).  The
+# points in a las tile are generally in flight-line order rather than spatial
+# order, so even a small area of interest may be scattered throughout the file.
+# The cell index divides the tile into square cells and, for each cell, stores the
+# runs of point records [start,stop) that contain its points.  Runs separated by
+# gaps of up to max_gap records are merged, which keeps the index small at the cost
+# of reading a few extra points.  A reader can then go straight to the records that
+# could intersect an area of interest.  The index is held in <tile>.cells.npz and
+# records the tile's modification time and size, so that stale indices are ignored.
+###################################################################################
+
+# sidecar file for the cell index of a las tile
+def cell_index_file(las_file):
+    return las_file + '.cells.npz'
+
+# build the cell index for a las tile and write it to the sidecar file
+def build_cell_index(las_file,cell_size=10.,max_gap=64):
+    lasFile = las.file.File(las_file,mode='r')
+    header = lasFile.header
+    min_xy = np.floor(np.asarray(header.min[:2],dtype='float'))
+    max_xy = np.asarray(header.max[:2],dtype='float')
+    scale = np.asarray(header.scale,dtype='float')
+    offset = np.asarray(header.offset,dtype='float')
+    n_cols = max(int(np.floor((max_xy[0]-min_xy[0])/cell_size))+1,1)
+    n_rows = max(int(np.floor((max_xy[1]-min_xy[1])/cell_size))+1,1)
+    col = np.clip(np.floor((lasFile.X*scale[0]+offset[0]-min_xy[0])/cell_size),0,n_cols-1).astype('int64')
+    row = np.clip(np.floor((lasFile.Y*scale[1]+offset[1]-min_xy[1])/cell_size),0,n_rows-1).astype('int64')
+    lasFile.close()
+    cell = row*n_cols+col
+
+    # record numbers sorted by cell (and by record number within each cell); a new run
+    # starts wherever the cell changes or the gap to the previous record is too large
+    order = np.argsort(cell,kind='mergesort')
+    cell = cell[order]
+    new_run = np.ones(order.size,dtype='bool')
+    new_run[1:] = (cell[1:]!=cell[:-1]) | (order[1:]-order[:-1] > max_gap+1)
+    run_start = np.nonzero(new_run)[0]
+    run_stop = np.append(run_start[1:],order.size)-1
+    run_cell = cell[run_start]
+    cell_ptr = np.searchsorted(run_cell,np.arange(n_rows*n_cols+1))
+
+    mtime,size = file_signature(las_file)
+    index = {'origin':min_xy, 'cell_size':cell_size, 'shape':np.array([n_rows,n_cols]),
+             'cell_ptr':cell_ptr, 'start':order[run_start], 'stop':order[run_stop]+1,
+             'mtime':mtime, 'size':size}
+    np.savez(cell_index_file(las_file),**index)
+    return index
+
+# build cell indices for a list of tiles on a pool of n_workers threads
+def build_cell_indices(las_files,cell_size=10.,max_gap=64,n_workers=8):
+    pool = ThreadPool(max(min(n_workers,len(las_files)),1))
+    pool.map(lambda las_file: build_cell_index(las_file,cell_size,max_gap),las_files)
+    pool.close()
+    pool.join()
+
+# load the cell index for a tile, or None if there isn't one or it is out of date
+def load_cell_index(las_file):
+    if not os.path.isfile(cell_index_file(las_file)):
+        return None
+    npz = np.load(cell_index_file(las_file))
+    index = {}
+    for key in npz.files:
+        index[key] = npz[key]
+    npz.close()
+    mtime,size = file_signature(las_file)
+    if mtime != index['mtime'] or size != index['size']:
+        return None
+    return index
+
+# Record numbers (sorted) of all points in cells that overlap bbox ([xmin,ymin,xmax,ymax])
+def cell_index_records(index,bbox):
+    n_rows,n_cols = index['shape']
+    c0 = int(np.clip(np.floor((bbox[0]-index['origin'][0])/index['cell_size']),0,n_cols-1))
+    c1 = int(np.clip(np.floor((bbox[2]-index['origin'][0])/index['cell_size']),0,n_cols-1))
+    r0 = int(np.clip(np.floor((bbox[1]-index['origin'][1])/index['cell_size']),0,n_rows-1))
+    r1 = int(np.clip(np.floor((bbox[3]-index['origin'][1])/index['cell_size']),0,n_rows-1))
+    cols,rows = np.meshgrid(np.arange(c0,c1+1),np.arange(r0,r1+1))
+    cells = (rows*n_cols+cols).ravel()
+    first = index['cell_ptr'][cells]
+    last = index['cell_ptr'][cells+1]
+    runs = np.concatenate([np.arange(a,b) for a,b in zip(first,last)]).astype('int64')
+    if runs.size == 0:
+        return np.zeros(0,dtype='int64')
+    records = np.concatenate([np.arange(a,b) for a,b in zip(index['start'][runs],index['stop'][runs])])
+    # runs merged across small gaps can overlap between neighbouring cells
+    return np.unique(records)
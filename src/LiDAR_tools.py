@@ -1,5 +1,9 @@
 import numpy as np
 import laspy as las
+import LiDAR_tile_catalog as tiles
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+import threading
 
 # Determine if a point is inside a given polygon or not
 # Polygon is a list of (x,y) pairs. This function
@@ -26,25 +30,147 @@ def point_in_poly(x,y,poly):
 
     return inside
 
+# The rings of a polygon given either as a single ring or as a list of rings (see
+# points_in_poly)
+def _polygon_rings(poly):
+    if isinstance(poly,(list,tuple)) and np.ndim(poly[0]) == 2:
+        return poly
+    return [poly]
+
+# Bounding box of a polygon's rings, and the margin kept on its left hand side when
+# prefiltering points (see points_in_poly)
+def _polygon_bounds(rings):
+    vertices = np.concatenate([np.asarray(ring,dtype='float').reshape(-1,2) for ring in rings],axis=0)
+    xmin,ymin = np.min(vertices,axis=0)
+    xmax,ymax = np.max(vertices,axis=0)
+    margin = 8*np.finfo('float').eps*(max(abs(xmin),abs(xmax))+(xmax-xmin))
+    return xmin,ymin,xmax,ymax,margin
+
+# Crossing test for points already sorted by y.  For each edge the points whose y lies
+# within the edge's span form a contiguous run found with a binary search, and the
+# edge's crossing test is evaluated once on that run only.  Returns True for points
+# crossed by an odd number of edges.
+def _ray_crossings(x,y,rings):
+    flip = np.zeros(x.size,dtype=bool)
+    for ring in rings:
+        n = len(ring)
+        p1x,p1y = ring[0]
+        for i in range(n+1):
+            p2x,p2y = ring[i % n]
+            if p1y!=p2y: # horizontal edges are never crossed
+                # points with min(p1y,p2y) < y <= max(p1y,p2y)
+                lo = np.searchsorted(y,min(p1y,p2y),side='right')
+                hi = np.searchsorted(y,max(p1y,p2y),side='right')
+                cross = x[lo:hi]<=max(p1x,p2x)
+                if p1x!=p2x:
+                    xints = (y[lo:hi]-p1y)*(p2x-p1x)/(p2y-p1y)+p1x
+                    cross &= x[lo:hi]<=xints
+                flip[lo:hi] ^= cross
+            p1x,p1y = p2x,p2y
+    return flip
+
 # This one is my own version of the ray-trace algorithm which utilises the numpy arrays so that a list of x and y coordinates can be processed in one call and only points inside polygon are returned alongside the indices in case required for future referencing.  This saves a fair bit of looping.
+# The polygon can either be a single ring (an (n,2) array or list of (x,y) pairs) or a
+# list of rings, in which case the first is the outer boundary and the others are holes
+# (the crossing count runs over the edges of every ring, so holes come out naturally).
+# Only points within the polygon's bounding box are tested.  These are sorted by y once,
+# so that each edge's crossing test is evaluated once on the run of points within its
+# y span only.  The crossing rule is exactly that of point_in_poly.
 def points_in_poly(x,y,poly):
-    n = len(poly)
-    inside=np.zeros(x.size,dtype=bool)
-    xints=np.zeros(x.size)
+    rings = _polygon_rings(poly)
+    inside = np.zeros(x.size,dtype=bool)
 
-    p1x,p1y = poly[0]
-    for i in range(n+1):
-        p2x,p2y=poly[i % n]
-        if p1y!=p2y:
-            xints[np.all([y>min(p1y,p2y), y<=max(p1y,p2y), x<=max(p1x,p2x)],axis=0)] = (y[np.all([y>min(p1y,p2y), y<=max(p1y,p2y), x<=max(p1x,p2x)],axis=0)]-p1y)*(p2x-p1x)/(p2y-p1y)+p1x
-        if p1x==p2x:
-            inside[np.all([y>min(p1y,p2y), y<=max(p1y,p2y), x<=max(p1x,p2x)],axis=0)] = np.invert(inside[np.all([y>min(p1y,p2y), y<=max(p1y,p2y), x<=max(p1x,p2x)],axis=0)])
-        else:
-            inside[np.all([y>min(p1y,p2y), y<=max(p1y,p2y), x<=max(p1x,p2x),x<=xints],axis=0)] = np.invert(inside[np.all([y>min(p1y,p2y), y<=max(p1y,p2y), x<=max(p1x,p2x),x<=xints],axis=0)])
-        p1x,p1y = p2x,p2y
+    # bounding box prefilter.  Points left of the box would be crossed by an even number
+    # of edges, but the intersection x-coordinates are subject to rounding, so a margin
+    # of a few ulps is kept on that side to reproduce the full test exactly.
+    xmin,ymin,xmax,ymax,margin = _polygon_bounds(rings)
+    candidates = np.nonzero(np.all((y>ymin, y<=ymax, x<=xmax, x>=xmin-margin),axis=0))[0]
+    order = np.argsort(y[candidates],kind='mergesort')
+    candidates = candidates[order]
 
+    inside[candidates] = _ray_crossings(x[candidates],y[candidates],rings)
     return x[inside],y[inside], inside
         
+# Label points with the index of the polygon they fall in (or -1 if none), for a set of
+# polygons such as the subplots of a plot.  The points are sorted once into vertical
+# strips about as wide as a typical polygon, and by y within each strip.  Each polygon
+# then only visits the strips overlapping its x range, takes the run of points within
+# its y range from each (found by binary search), keeps those within its x range and
+# passes them, still sorted by y, to the crossing test.  The result for each polygon is
+# the same as from points_in_poly.  Points are assigned to the first polygon that
+# contains them.
+def label_points_by_polygons(x,y,polygons):
+    labels = np.zeros(x.size,dtype='int64')-1
+    if x.size == 0 or len(polygons) == 0:
+        return labels
+    rings = [_polygon_rings(poly) for poly in polygons]
+    bounds = np.array([_polygon_bounds(poly_rings) for poly_rings in rings])
+
+    # sort the points into strips, and by y within each strip
+    strip_width = np.median(bounds[:,2]-bounds[:,0])
+    if not strip_width > 0:
+        strip_width = max(np.max(x)-np.min(x),1.)
+    x0 = np.min(x)
+    strip = np.floor((x-x0)/strip_width).astype('int64')
+    n_strips = strip.max()+1
+    order = np.argsort(strip)
+    strip_start = np.searchsorted(strip[order],np.arange(n_strips+1))
+    ys = y[order]
+    for ss in range(0,n_strips):
+        start = strip_start[ss]
+        end = strip_start[ss+1]
+        order[start:end] = order[start:end][np.argsort(ys[start:end])]
+    xs = x[order]
+    ys = y[order]
+
+    for pp in range(0,len(polygons)):
+        xmin,ymin,xmax,ymax,margin = bounds[pp]
+        first = max(int(np.floor((xmin-margin-x0)/strip_width)),0)
+        last = min(int(np.floor((xmax-x0)/strip_width)),n_strips-1)
+        for ss in range(first,last+1):
+            start = strip_start[ss]
+            lo = start+np.searchsorted(ys[start:strip_start[ss+1]],ymin,side='right')
+            hi = start+np.searchsorted(ys[start:strip_start[ss+1]],ymax,side='right')
+            run = lo+np.nonzero((xs[lo:hi]<=xmax) & (xs[lo:hi]>=xmin-margin))[0]
+            run = order[run[_ray_crossings(xs[run],ys[run],rings[pp])]]
+            labels[run[labels[run]==-1]] = pp
+    return labels
+
+# Relationship between a polygon (a single ring or a list of rings, as for points_in_poly)
+# and an axis aligned rectangle (e.g. the extent of a las tile) given by its lower left
+# and upper right corners.  Returns 0 if they are disjoint, 1 if they intersect and 2 if
+# the rectangle lies entirely within the polygon.  The rectangle is treated as touching an
+# edge if it comes within a few ulps of it, so that it is only reported as contained when
+# every point in it would pass points_in_poly.
+def polygon_rectangle_relation(poly,rect_min,rect_max):
+    rings = _polygon_rings(poly)
+    margin = 8*np.finfo('float').eps*(np.max(np.abs(np.concatenate((rect_min,rect_max))))+np.max(np.asarray(rect_max)-np.asarray(rect_min)))
+    xmin = rect_min[0]-margin
+    ymin = rect_min[1]-margin
+    xmax = rect_max[0]+margin
+    ymax = rect_max[1]+margin
+    for ring in rings:
+        ring = np.asarray(ring,dtype='float').reshape(-1,2)
+        p1 = ring
+        p2 = np.roll(ring,-1,axis=0)
+        # edges whose bounding box overlaps the rectangle, and which have rectangle corners
+        # on both sides of (or on) the line through them
+        overlap = np.all((np.minimum(p1[:,0],p2[:,0])<=xmax, np.maximum(p1[:,0],p2[:,0])>=xmin,
+                          np.minimum(p1[:,1],p2[:,1])<=ymax, np.maximum(p1[:,1],p2[:,1])>=ymin),axis=0)
+        dx = p2[:,0]-p1[:,0]
+        dy = p2[:,1]-p1[:,1]
+        side = np.zeros((ring.shape[0],4))
+        for cc,(cx,cy) in enumerate([(xmin,ymin),(xmax,ymin),(xmax,ymax),(xmin,ymax)]):
+            side[:,cc] = dx*(cy-p1[:,1])-dy*(cx-p1[:,0])
+        crosses = ~(np.all(side>0,axis=1) | np.all(side<0,axis=1))
+        if np.any(overlap & crosses):
+            return 1
+    # no edge meets the rectangle, so it is either wholly inside or wholly outside
+    temp1,temp2,inside = points_in_poly(np.asarray([xmin]),np.asarray([ymin]),poly)
+    if inside[0]:
+        return 2
+    return 0
+
 # This retrieves all points within circular neighbourhood,  Terget point is the location around which the neighbourhood search is conducted, for a specified search radius.  x and y are vectors with the x and y coordinates of the test points
 def points_in_radius(x,y,target_x, target_y,radius):
     inside=np.zeros(x.size,dtype=bool)
@@ -55,13 +181,376 @@ def points_in_radius(x,y,target_x, target_y,radius):
 
 
 
+# Compact point storage.  The standard point array used throughout this library is an
+# Nx6 float64 array with columns x,y,z,return,class,scan_angle, which costs 48 bytes per
+# point.  Here the coordinates are held as scaled int32 integers (as they are stored in
+# the las file itself) and the return number, classification and scan angle as single
+# bytes, giving 15 bytes per point.
+compact_point_dtype = np.dtype([('X','<i4'),('Y','<i4'),('Z','<i4'),('return_num','u1'),('classification','u1'),('scan_angle','i1')])
+
+# CompactPointCloud wraps a structured array of compact_point_dtype records together with
+# the scale and offset needed to decode the coordinates.  It supports the same indexing
+# as the Nx6 float array (pts[:,k], pts[mask,:], pts[mask,k]), so it can be passed
+# straight into the filtering and LAD profile functions.  Columns 3-5 are returned as
+# zero-copy views of the record array; columns 0-2 are decoded to metres on access.
+class CompactPointCloud(object):
+
+    def __init__(self,records,scale,offset):
+        self.records = records
+        self.scale = np.asarray(scale,dtype='float')
+        self.offset = np.asarray(offset,dtype='float')
+
+    def __len__(self):
+        return self.records.size
+
+    @property
+    def shape(self):
+        return (self.records.size,6)
+
+    @property
+    def nbytes(self):
+        return self.records.nbytes
+
+    # return column col (0-5, ordered as in the float array) for the points indexed by rows
+    def column(self,col,rows=slice(None)):
+        if col < 3:
+            name = compact_point_dtype.names[col]
+            return self.records[name][rows]*self.scale[col]+self.offset[col]
+        return self.records[compact_point_dtype.names[col]][rows]
+
+    def subset(self,rows):
+        return CompactPointCloud(self.records[rows],self.scale,self.offset)
+
+    def __getitem__(self,key):
+        if isinstance(key,tuple):
+            rows,col = key
+            if isinstance(col,slice) and col == slice(None):
+                return self.subset(rows)
+            return self.column(col,rows)
+        return self.subset(key)
+
+    # expand back into the standard Nx6 float array
+    def to_array(self):
+        pts = np.zeros((self.records.size,6))
+        for cc in range(0,6):
+            pts[:,cc] = self.column(cc)
+        return pts
+
+# PointSelection is a lazy subset of a point array (a standard Nx6 array, a
+# CompactPointCloud or a LasPointMap): it holds the parent array plus the indices of
+# the selected rows.  Taking a subset of a selection (pts[mask,:], as done by the
+# filtering functions) only composes the indices, so chains of clips such as full
+# cloud -> plot -> subplot do not copy the point data at each step.  Column access
+# (pts[:,k]) gathers just that column from the parent.  Call materialise() to get a
+# contiguous point array of the parent's type when a kernel will make many passes
+# over the same points.
+class PointSelection(object):
+
+    def __init__(self,parent,index):
+        self.parent = parent
+        self.index = index
+
+    def __len__(self):
+        return self.index.size
+
+    @property
+    def shape(self):
+        return (self.index.size,6)
+
+    def column(self,col,rows=slice(None)):
+        return self.parent[self.index[rows],col]
+
+    def subset(self,rows):
+        return PointSelection(self.parent,self.index[rows])
+
+    def __getitem__(self,key):
+        if isinstance(key,tuple):
+            rows,col = key
+            if isinstance(col,slice) and col == slice(None):
+                return self.subset(rows)
+            return self.column(col,rows)
+        return self.subset(key)
+
+    def materialise(self):
+        if isinstance(self.parent,np.ndarray):
+            return self.parent[self.index,:]
+        return self.parent.subset(self.index)
+
+    def to_array(self):
+        pts = self.materialise()
+        if isinstance(pts,CompactPointCloud):
+            return pts.to_array()
+        return pts
+
+# start a lazy selection covering all points of a point array
+def lazy_selection(pts):
+    if isinstance(pts,PointSelection):
+        return pts
+    return PointSelection(pts,np.arange(pts.shape[0]))
+
+# convert a standard Nx6 point array into a CompactPointCloud.  The default scale matches
+# the 1 cm precision of the las files we use; the offset defaults to the minimum corner of
+# the point cloud so that the int32 coordinates cannot overflow.
+def compact_points(pts,scale=[0.01,0.01,0.01],offset=None):
+    scale = np.asarray(scale,dtype='float')
+    if offset is None:
+        if pts.shape[0] > 0:
+            offset = np.floor(np.min(pts[:,:3],axis=0))
+        else:
+            offset = np.zeros(3)
+    offset = np.asarray(offset,dtype='float')
+    records = np.zeros(pts.shape[0],dtype=compact_point_dtype)
+    for cc in range(0,3):
+        records[compact_point_dtype.names[cc]] = np.round((pts[:,cc]-offset[cc])/scale[cc])
+    for cc in range(3,6):
+        records[compact_point_dtype.names[cc]] = pts[:,cc]
+    return CompactPointCloud(records,scale,offset)
+
+# an empty point array of either type.  A compact one is given the default grid of
+# compact_points unless a scale and offset are passed in; it never sets the grid of the
+# points it is concatenated with (see concatenate_points).
+def empty_points(compact=False,scale=[0.01,0.01,0.01],offset=[0.,0.,0.]):
+    if compact:
+        return CompactPointCloud(np.zeros(0,dtype=compact_point_dtype),np.asarray(scale,dtype='float'),np.asarray(offset,dtype='float'))
+    return np.zeros((0,6))
+
+# re-encode a CompactPointCloud onto a different coordinate grid (scale and offset)
+def regrid_points(pts,scale,offset):
+    if np.all(pts.scale==scale) and np.all(pts.offset==offset):
+        return pts
+    records = pts.records.copy()
+    for cc in range(0,3):
+        records[compact_point_dtype.names[cc]] = np.round((pts.column(cc)-offset[cc])/scale[cc])
+    return CompactPointCloud(records,scale,offset)
+
+# join a list of point arrays (either standard Nx6 arrays or CompactPointClouds) into
+# a single point array of the same type.  PointSelections are materialised first.
+# Compact clouds are re-encoded onto the grid (scale and offset) of the first cloud
+# that holds any points, so an empty tile at the head of the list cannot coarsen the
+# others; if every cloud is empty the first one's grid is kept.
+def concatenate_points(pts_list):
+    pts_list = [pts.materialise() if isinstance(pts,PointSelection) else pts for pts in pts_list]
+    if not isinstance(pts_list[0],CompactPointCloud):
+        return np.concatenate(pts_list,axis=0)
+    reference = pts_list[0]
+    for pts in pts_list:
+        if len(pts) > 0:
+            reference = pts
+            break
+    scale = reference.scale
+    offset = reference.offset
+    records = [regrid_points(pts,scale,offset).records for pts in pts_list]
+    return CompactPointCloud(np.concatenate(records),scale,offset)
+
+# Byte layout of the fields used by this library within a las point record.  Point
+# formats 0-5 share the legacy layout; formats 6-10 (LAS 1.4) use wider return and
+# classification fields and a 16 bit scan angle.  Any remaining bytes in the record
+# (gps time, colour, extra bytes etc.) are skipped by setting itemsize to the full
+# record length.
+def las_record_dtype(point_format,record_length):
+    if point_format < 6:
+        names = ['X','Y','Z','flag_byte','raw_classification','scan_angle_rank']
+        formats = ['<i4','<i4','<i4','u1','u1','i1']
+        offsets = [0,4,8,14,15,16]
+    else:
+        names = ['X','Y','Z','flag_byte','classification','scan_angle']
+        formats = ['<i4','<i4','<i4','u1','u1','<i2']
+        offsets = [0,4,8,14,16,18]
+    return np.dtype({'names':names,'formats':formats,'offsets':offsets,'itemsize':record_length})
+
+# Check whether a las file is compressed (laz), from the compression bits of the point
+# data format in its header
+def las_file_is_compressed(las_file):
+    f = open(las_file,'rb')
+    f.seek(104)
+    point_format = ord(f.read(1))
+    f.close()
+    return (point_format & 0x80) != 0 and (point_format & 0x40) == 0
+
+# LasPointMap gives zero-copy access to the point records of a las file through a numpy
+# memory map, so opening even a very large file only costs reading the header.  Raw
+# fields (X, Y, Z, flag_byte etc.) are views straight onto the file; the standard
+# x,y,z,return,class,scan_angle columns are decoded from them only when requested, and
+# only for the requested rows.  Pages are shared between processes mapping the same file.
+# It supports the same indexing as the Nx6 float array and CompactPointCloud, with
+# pts[rows,:] materialising the selected points as a standard Nx6 array.  Note that
+# unlike load_lidar_data, no z>=0 filter is applied.
+# Compressed (laz) files cannot be mapped; these are decompressed by laspy (which needs
+# laszip) and the records are held in memory instead.
+class LasPointMap(object):
+
+    def __init__(self,las_file):
+        self.las_file = las_file
+        self.compressed = las_file_is_compressed(las_file)
+        try:
+            lasFile = las.file.File(las_file,mode='r')
+        except las.util.LaspyException as e:
+            if self.compressed:
+                raise IOError('unable to decompress ' + las_file + ' (reading laz files requires laszip): ' + str(e))
+            raise
+        header = lasFile.header
+        self.point_format = header.data_format_id
+        self.scale = np.asarray(header.scale,dtype='float')
+        self.offset = np.asarray(header.offset,dtype='float')
+        n_pts = header.point_records_count
+        dtype = las_record_dtype(self.point_format,header.data_record_length)
+        data_offset = header.data_offset
+        if n_pts > 0 and self.compressed:
+            self.records = np.array(lasFile.points.view(dtype).ravel())
+        elif n_pts > 0:
+            self.records = np.memmap(las_file,dtype=dtype,mode='r',offset=data_offset,shape=(n_pts,))
+        else:
+            self.records = np.zeros(0,dtype=dtype)
+        lasFile.close()
+
+    def __len__(self):
+        return self.records.size
+
+    @property
+    def shape(self):
+        return (self.records.size,6)
+
+    # return column col (0-5, ordered as in the float array) for the points indexed by rows
+    def column(self,col,rows=slice(None)):
+        if col < 3:
+            return self.records['XYZ'[col]][rows]*self.scale[col]+self.offset[col]
+        if col == 3:
+            if self.point_format < 6:
+                return self.records['flag_byte'][rows] & 7
+            return self.records['flag_byte'][rows] & 15
+        if col == 4:
+            if self.point_format < 6:
+                return self.records['raw_classification'][rows] & 31
+            return self.records['classification'][rows]
+        if self.point_format < 6:
+            return self.records['scan_angle_rank'][rows]
+        return np.round(self.records['scan_angle'][rows]*0.006)
+
+    # materialise the points indexed by rows as an Nx6 array (or only the listed columns)
+    def subset(self,rows,columns=None):
+        if columns is None:
+            columns = range(0,6)
+        if isinstance(rows,slice):
+            n_pts = len(range(*rows.indices(self.records.size)))
+        elif np.asarray(rows).dtype == bool:
+            n_pts = np.sum(rows)
+        else:
+            n_pts = np.asarray(rows).size
+        pts = np.zeros((n_pts,len(columns)))
+        for cc in range(0,len(columns)):
+            pts[:,cc] = self.column(columns[cc],rows)
+        return pts
+
+    # materialise the points indexed by rows as a CompactPointCloud.  The coordinates
+    # are copied without rescaling, so they stay on the las file's grid.
+    def compact_subset(self,rows):
+        selected = self.records[rows]
+        records = np.zeros(selected.size,dtype=compact_point_dtype)
+        records['X'] = selected['X']
+        records['Y'] = selected['Y']
+        records['Z'] = selected['Z']
+        for cc in range(3,6):
+            records[compact_point_dtype.names[cc]] = self.column(cc,rows)
+        return CompactPointCloud(records,self.scale,self.offset)
+
+    def __getitem__(self,key):
+        if isinstance(key,tuple):
+            rows,col = key
+            if isinstance(col,slice) and col == slice(None):
+                return self.subset(rows)
+            return self.column(col,rows)
+        return self.subset(key)
+
+    def to_array(self):
+        return self.subset(slice(None))
+
+# open a las file in memory-mapped mode (see LasPointMap)
+def map_lidar_data(las_file):
+    return LasPointMap(las_file)
+
 # Load lidar data => x,y,z,return,class
-def load_lidar_data(las_file):#,subplot_coords,max_height,bin_width):
-    lasFile = las.file.File(las_file,mode='r')
-    #pts = np.vstack((lasFile.x*lasFile.header.scale[0]+lasFile.header.offset[0], lasFile.y*lasFile.header.scale[1]+lasFile.header.offset[1], lasFile.z*lasFile.header.scale[2]+lasFile.header.offset[2], lasFile.return_num, lasFile.classification)).transpose()
-    pts = np.vstack((lasFile.x, lasFile.y, lasFile.z, lasFile.return_num, lasFile.classification, lasFile.scan_angle_rank)).transpose()
-    pts = pts[pts[:,2]>=0,:]
-    print "loaded ", pts[:,0].size, " points"
+# Set compact=True to return a CompactPointCloud rather than an Nx6 float array.  See
+# load_lidar_data_by_chunk for the column and predicate options.
+def load_lidar_data(las_file,compact=False,columns=None,max_return=None,classes=None,z_min=0,z_max=None,bbox=None):#,subplot_coords,max_height,bin_width):
+    chunks = list(load_lidar_data_by_chunk(las_file,compact=compact,columns=columns,max_return=max_return,classes=classes,z_min=z_min,z_max=z_max,bbox=bbox))
+    if len(chunks) == 0:
+        # a file with no points; a compact placeholder keeps the file's own grid
+        if compact:
+            pts = LasPointMap(las_file).compact_subset(slice(0,0))
+        else:
+            pts = empty_points()
+            if columns is not None:
+                pts = pts[:,columns]
+    else:
+        pts = concatenate_points(chunks)
+    print "loaded ", pts.shape[0], " points"
+    return pts
+
+# Record numbers of the points in a block of rows (a slice or an array of record
+# numbers) of a LasPointMap that pass the read-time predicates.  The cheap integer
+# tests are applied first, and each subsequent column is only decoded for the points
+# that are still in play.
+def select_points(pmap,rows,max_return=None,classes=None,z_min=0,z_max=None,bbox=None):
+    if isinstance(rows,slice):
+        index = np.arange(rows.start,rows.stop)
+    else:
+        index = np.asarray(rows)
+    if max_return is not None:
+        index = index[pmap.column(3,index)<=max_return]
+    if classes is not None:
+        index = index[np.in1d(pmap.column(4,index),classes)]
+    if z_min is not None or z_max is not None:
+        z = pmap.column(2,index)
+        keep = np.ones(index.size,dtype='bool')
+        if z_min is not None:
+            keep &= z>=z_min
+        if z_max is not None:
+            keep &= z<=z_max
+        index = index[keep]
+    if bbox is not None: # bbox = [xmin,ymin,xmax,ymax]
+        x = pmap.column(0,index)
+        y = pmap.column(1,index)
+        index = index[np.all((x>=bbox[0],x<=bbox[2],y>=bbox[1],y<=bbox[3]),axis=0)]
+    return index
+
+# Generator that reads a las file in blocks of chunk_size points, so that large tiles
+# can be streamed through the filtering and binning code in bounded memory.  Points are
+# filtered as each block is decoded, so only the points that are kept are ever
+# materialised:
+# - max_return  :: keep returns with return number <= max_return
+# - classes     :: keep only these classifications (e.g. [1,2])
+# - z_min,z_max :: height range; by default points below the ground (z<0) are removed,
+#                  as in load_lidar_data.  Set z_min=None to keep everything.
+# - bbox        :: [xmin,ymin,xmax,ymax]
+# columns is an optional list of column indices (0-5 => x,y,z,return,class,scan_angle)
+# to decode, in which case the Nx6 array is replaced by one with only these columns, in
+# the order given.  It is ignored for compact output, which always holds all fields.
+def load_lidar_data_by_chunk(las_file,chunk_size=1000000,compact=False,columns=None,max_return=None,classes=None,z_min=0,z_max=None,bbox=None):
+    pmap = LasPointMap(las_file)
+    n_pts = len(pmap)
+    for start in range(0,n_pts,chunk_size):
+        rows = slice(start,min(start+chunk_size,n_pts))
+        index = select_points(pmap,rows,max_return,classes,z_min,z_max,bbox)
+        if compact:
+            yield pmap.compact_subset(index)
+        else:
+            yield pmap.subset(index,columns)
+
+# Load the points of a las file that lie within bbox ([xmin,ymin,xmax,ymax]).  If the
+# tile has an up-to-date cell index (see LiDAR_tile_catalog.build_cell_index) only the
+# point records in the cells overlapping bbox are read; otherwise the whole file is
+# scanned with the bbox applied as a read-time predicate.
+def load_lidar_data_in_bbox(las_file,bbox,compact=False):
+    index = tiles.load_cell_index(las_file)
+    if index is None:
+        return load_lidar_data(las_file,compact=compact,bbox=bbox)
+    pmap = LasPointMap(las_file)
+    rows = select_points(pmap,tiles.cell_index_records(index,bbox),bbox=bbox)
+    if compact:
+        pts = pmap.compact_subset(rows)
+    else:
+        pts = pmap.subset(rows)
+    print "loaded ", pts.shape[0], " points"
     return pts
 
 # filter lidar wth polygon
@@ -70,12 +559,91 @@ def filter_lidar_data_by_polygon(in_pts,polygon):
     pts = in_pts[inside,:]
     return pts
 
+# split a point array into one point array per polygon (e.g. the subplots of a plot) in
+# a single labelling pass, rather than clipping the cloud once per polygon.  Points keep
+# their original order within each polygon.
+def filter_lidar_data_by_polygons(in_pts,polygons):
+    labels = label_points_by_polygons(in_pts[:,0],in_pts[:,1],polygons)
+    return split_points_by_label(in_pts,labels,len(polygons))
+
+# split a point array into n_labels point arrays using an integer label per point (points
+# labelled -1 are dropped), with a single stable sort of the labels
+def split_points_by_label(in_pts,labels,n_labels):
+    order = np.argsort(labels,kind='mergesort')
+    bounds = np.cumsum(np.bincount(labels+1,minlength=n_labels+1))
+    return [in_pts[order[bounds[ll]:bounds[ll+1]],:] for ll in range(0,n_labels)]
+
 # filter lidar by circular neighbourhood
 def filter_lidar_data_by_neighbourhood(in_pts,target_xy,radius):
     x,y,inside =  points_in_radius(in_pts[:,0],in_pts[:,1],target_xy[0],target_xy[1],radius)
     pts = in_pts[inside,:]
     return pts
 
+# Uniform grid over the xy positions of a point cloud, for repeated neighbourhood queries.
+# The points are sorted once by grid cell (row-major), so that each row of cells covered by
+# a query is a contiguous run of the sorted points; only these runs are tested against the
+# radius, using the same distance test as points_in_radius.
+class PointGrid(object):
+
+    def __init__(self,x,y,cell_size=5.):
+        self.cell_size = float(cell_size)
+        self.origin = np.asarray([np.min(x),np.min(y)]) if x.size > 0 else np.zeros(2)
+        cx = np.floor((x-self.origin[0])/self.cell_size).astype('int64')
+        cy = np.floor((y-self.origin[1])/self.cell_size).astype('int64')
+        self.nx = cx.max()+1 if x.size > 0 else 1
+        self.ny = cy.max()+1 if x.size > 0 else 1
+        cell = cy*self.nx+cx
+        self.order = np.argsort(cell,kind='mergesort')
+        self.cell_ptr = np.zeros(self.nx*self.ny+1,dtype='int64')
+        self.cell_ptr[1:] = np.cumsum(np.bincount(cell,minlength=self.nx*self.ny))
+        self.x = x[self.order]
+        self.y = y[self.order]
+
+    # indices (in ascending order) of the points within radius of (target_x,target_y)
+    def query_radius(self,target_x,target_y,radius):
+        pad = radius+1e-9*(abs(target_x)+abs(target_y)+radius)
+        cx0 = max(int(np.floor((target_x-pad-self.origin[0])/self.cell_size)),0)
+        cx1 = min(int(np.floor((target_x+pad-self.origin[0])/self.cell_size)),self.nx-1)
+        cy0 = max(int(np.floor((target_y-pad-self.origin[1])/self.cell_size)),0)
+        cy1 = min(int(np.floor((target_y+pad-self.origin[1])/self.cell_size)),self.ny-1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.zeros(0,dtype='int64')
+        rows = np.arange(cy0,cy1+1)*self.nx
+        starts = self.cell_ptr[rows+cx0]
+        stops = self.cell_ptr[rows+cx1+1]
+        candidates = np.concatenate([np.arange(a,b) for a,b in zip(starts,stops)])
+        d2=(self.x[candidates]-target_x)**2+(self.y[candidates]-target_y)**2
+        return np.sort(self.order[candidates[d2<=radius**2]])
+
+    # indices of the points within each of a set of neighbourhoods; xy is an Nx2 array of
+    # centres and radius is either a single radius or one per centre.  With n_workers>1 the
+    # queries are run on a thread pool.
+    def query_radii(self,xy,radius,n_workers=1):
+        xy = np.asarray(xy,dtype='float').reshape(-1,2)
+        radii = np.zeros(xy.shape[0])+radius
+        query = lambda ii: self.query_radius(xy[ii,0],xy[ii,1],radii[ii])
+        if n_workers > 1 and xy.shape[0] > 1:
+            pool = ThreadPool(min(n_workers,xy.shape[0]))
+            try:
+                indices = pool.map(query,range(0,xy.shape[0]))
+            finally:
+                pool.close()
+        else:
+            indices = [query(ii) for ii in range(0,xy.shape[0])]
+        return indices
+
+# build a PointGrid for a point cloud
+def grid_points(in_pts,cell_size=5.):
+    return PointGrid(in_pts[:,0],in_pts[:,1],cell_size)
+
+# filter lidar by many circular neighbourhoods at once (see filter_lidar_data_by_neighbourhood);
+# returns a list of point arrays, one per centre in xy.  A PointGrid from grid_points can be
+# passed in to reuse it across calls on the same point cloud.
+def filter_lidar_data_by_neighbourhoods(in_pts,xy,radius,grid=None,n_workers=1):
+    if grid is None:
+        grid = grid_points(in_pts)
+    return [in_pts[inside,:] for inside in grid.query_radii(xy,radius,n_workers)]
+
 
 # get bounding box from las file
 def get_lasfile_bbox(las_file):
@@ -89,36 +657,160 @@ def get_lasfile_bbox(las_file):
     
     return UR, LR, UL, LL
 
-# find all las files from a list that are located within a specified polygon
+# find all las files from a list that are located within a specified polygon.  Tile
+# extents are taken from the tile catalogue (see LiDAR_tile_catalog), so the las files
+# themselves are only opened when the catalogue is first built or a tile has changed,
+# and the spatial index over the catalogue limits the per-tile test to the tiles that
+# overlap the polygon's bounding box.
 def find_las_files_by_polygon(file_list,polygon):
-    las_files = np.genfromtxt(file_list,delimiter=',',dtype='S256')
-    keep = []
-    n_files = las_files.size
-    for i in range(0,n_files):
-        UR, LR, UL, LL = get_lasfile_bbox(las_files[i])
-        las_box = np.asarray([UR,LR,LL,UL])
-        x,y,inside = points_in_poly(polygon[:,0],polygon[:,1],las_box)
-        if inside.sum()>0:
-            keep.append(las_files[i])
+    keep = find_las_files_by_polygons(file_list,[polygon])[0]
     print 'las tiles to load in:', len(keep)
     for ll in range(0,len(keep)):
         print keep[ll]
     return keep
 
-# load all lidar points from multiple las files witin specified polygon.  The file list needs to have either the full or relative path to the files included.
-def load_lidar_data_by_polygon(file_list,polygon):
-    keep_files = find_las_files_by_polygon(file_list,polygon)
-    n_files = len(keep_files)
+# batch version of the above for a list of polygons, returning a list of files to load
+# for each polygon
+def find_las_files_by_polygons(file_list,polygons):
+    return [keep for keep,contained in classify_las_files_by_polygons(file_list,polygons)]
+
+# For each of a list of polygons, find the las files whose extent intersects the polygon
+# (candidates from the tile index, followed by an exact polygon/rectangle test), and flag
+# those that lie entirely within it.  Returns a list with a (files, contained) pair per
+# polygon, where contained is a boolean array.
+def classify_las_files_by_polygons(file_list,polygons):
+    catalog, rtree = tiles.load_tile_rtree(file_list)
+    las_files = catalog['files']
+    candidates = rtree.query_polygon(polygons)
+    keep_list = []
+    for pp in range(0,len(polygons)):
+        polygon = polygons[pp]
+        keep = []
+        contained = []
+        for i in candidates[pp]:
+            relation = polygon_rectangle_relation(polygon,catalog['min'][i][:2],catalog['max'][i][:2])
+            if relation>0:
+                keep.append(las_files[i])
+                contained.append(relation==2)
+        keep_list.append((keep,np.asarray(contained,dtype=bool)))
+    return keep_list
+
+# In-process cache of decoded las tiles for long running jobs that revisit the same
+# tiles (e.g. working through a list of neighbouring AOIs).  Tiles are held in least
+# recently used order and evicted once the total size of the cached point arrays
+# exceeds max_bytes; a tile larger than the whole budget is returned but not cached.
+# The cache can pre-filter tiles as they are loaded (max_return and classes, as for
+# load_lidar_data) so that only the points that will be used are held in memory.
+# Entries are keyed on the file name and point type, and are reloaded if the file's
+# modification time or size changes.  All access to the cache is guarded by a lock, so
+# it can be shared by the loader threads.
+class TileCache(object):
+
+    def __init__(self,max_bytes=4*1024**3,max_return=None,classes=None):
+        self.max_bytes = max_bytes
+        self.max_return = max_return
+        self.classes = classes
+        self.tiles = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self,las_file,compact=False):
+        key = (las_file,compact)
+        signature = tiles.file_signature(las_file)
+        with self.lock:
+            if key in self.tiles and self.tiles[key][0] == signature:
+                self.hits += 1
+                pts = self.tiles.pop(key)[1]
+                self.tiles[key] = (signature,pts)
+                return pts
+            self.misses += 1
+        pts = load_lidar_data(las_file,compact=compact,max_return=self.max_return,classes=self.classes)
+        with self.lock:
+            if key in self.tiles:
+                self.nbytes -= self.tiles.pop(key)[1].nbytes
+            if pts.nbytes <= self.max_bytes:
+                self.tiles[key] = (signature,pts)
+                self.nbytes += pts.nbytes
+                while self.nbytes > self.max_bytes:
+                    self.nbytes -= self.tiles.popitem(last=False)[1][1].nbytes
+        return pts
+
+    def clear(self):
+        with self.lock:
+            self.tiles.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {'hits':self.hits,'misses':self.misses,'tiles':len(self.tiles),'nbytes':self.nbytes,'max_bytes':self.max_bytes}
+
+# the tile cache used by the multi-tile loaders (disabled by default)
+tile_cache = None
+
+# switch on caching of decoded tiles for the multi-tile loaders, returning the cache
+def enable_tile_cache(max_bytes=4*1024**3,max_return=None,classes=None):
+    global tile_cache
+    tile_cache = TileCache(max_bytes,max_return,classes)
+    return tile_cache
+
+def disable_tile_cache():
+    global tile_cache
+    tile_cache = None
+
+# Load a set of las tiles and clip each one with filter_function (which takes and
+# returns a point array).  Tiles are read and clipped concurrently on a pool of
+# n_workers threads (reading is mostly I/O and numpy work, which release the GIL), and
+# the clipped tiles are joined with a single concatenation at the end.
+# If bbox is given, only points inside it are read from each tile (using the tile's
+# cell index, if it has one).  If the tile cache is enabled (or a TileCache is passed
+# in as cache), whole tiles are taken from (or loaded into) the cache instead.
+# filter_function can also be a list with one function per file; a None entry marks a
+# tile that lies wholly within the area of interest, which is loaded in full and not
+# filtered.
+def load_and_filter_tiles(las_files,filter_function,compact=False,n_workers=4,bbox=None,cache=None):
+    if cache is None:
+        cache = tile_cache
+    n_files = len(las_files)
+    if callable(filter_function):
+        filter_functions = [filter_function]*n_files
+    else:
+        filter_functions = filter_function
+    def load_and_filter(ii):
+        las_file = las_files[ii]
+        if cache is not None:
+            tile_pts = cache.get(las_file,compact)
+        elif bbox is None or filter_functions[ii] is None:
+            tile_pts = load_lidar_data(las_file,compact=compact)
+        else:
+            tile_pts = load_lidar_data_in_bbox(las_file,bbox,compact=compact)
+        if filter_functions[ii] is None:
+            return tile_pts
+        return filter_functions[ii](tile_pts)
     if n_files == 0:
-        print 'WARNING: No files within specified polygon - try again'
+        return empty_points(compact)
+    if n_workers > 1 and n_files > 1:
+        pool = ThreadPool(min(n_workers,n_files))
+        tile_pts = pool.map(load_and_filter,range(0,n_files))
+        pool.close()
+        pool.join()
     else:
-        tile_pts = load_lidar_data(keep_files[0])
-        pts = filter_lidar_data_by_polygon(tile_pts,polygon)
-        for i in range(1,n_files):
-            tile_pts = load_lidar_data(keep_files[i])
-            tile_pts_filt = filter_lidar_data_by_polygon(tile_pts,polygon)
-            pts = np.concatenate((pts,tile_pts_filt),axis=0)
+        tile_pts = [load_and_filter(ii) for ii in range(0,n_files)]
+    return concatenate_points(tile_pts)
 
+# load all lidar points from multiple las files witin specified polygon.  The file list needs to have either the full or relative path to the files included.
+# Tiles that lie entirely within the polygon are loaded without the per-point polygon test.
+def load_lidar_data_by_polygon(file_list,polygon,compact=False,n_workers=4):
+    keep_files,contained = classify_las_files_by_polygons(file_list,[polygon])[0]
+    print 'las tiles to load in:', len(keep_files)
+    for ll in range(0,len(keep_files)):
+        print keep_files[ll]
+    if len(keep_files) == 0:
+        print 'WARNING: No files within specified polygon - try again'
+    bbox = [np.min(polygon[:,0]),np.min(polygon[:,1]),np.max(polygon[:,0]),np.max(polygon[:,1])]
+    filters = [None if contained[ll] else (lambda tile_pts: filter_lidar_data_by_polygon(tile_pts,polygon)) for ll in range(0,len(keep_files))]
+    pts = load_and_filter_tiles(keep_files,filters,compact,n_workers,bbox)
     print "loaded ", pts[:,0].size, " points"
     return pts
 
@@ -128,30 +820,139 @@ def find_las_files_by_neighbourhood(file_list,xy,radius):
     keep = find_las_files_by_polygon(file_list,polygon)
     return keep
 
-def load_lidar_data_by_neighbourhood(file_list,xy,radius):
+def load_lidar_data_by_neighbourhood(file_list,xy,radius,compact=False,n_workers=4):
     polygon = np.asarray([[xy[0]+radius,xy[1]+radius], [xy[0]+radius,xy[1]-radius], [xy[0]-radius,xy[1]-radius], [xy[0]-radius,xy[1]+radius]])
 
     keep_files = find_las_files_by_polygon(file_list,polygon)
-    n_files = len(keep_files)
-    if n_files == 0:
+    if len(keep_files) == 0:
         print 'WARNING: No files within specified neighbourhood - try again'
-    else:
-        tile_pts = load_lidar_data(keep_files[0])
-        pts = filter_lidar_data_by_neighbourhood(tile_pts,xy,radius)
-        for i in range(1,n_files):
-            tile_pts = load_lidar_data(keep_files[i])
-            tile_pts_filt = filter_lidar_data_by_neighbourhood(tile_pts,xy,radius)
-            pts = np.concatenate((pts,tile_pts_filt),axis=0)
-
+    bbox = [xy[0]-radius,xy[1]-radius,xy[0]+radius,xy[1]+radius]
+    pts = load_and_filter_tiles(keep_files,lambda tile_pts: filter_lidar_data_by_neighbourhood(tile_pts,xy,radius),compact,n_workers,bbox)
     print "loaded ", pts[:,0].size, " points"
     return pts
 
+# Generator that loads the points for a sequence of AOIs (polygons) in order.  While
+# the caller works on one AOI, the tiles needed by the next lookahead AOIs are read
+# into a tile cache on n_workers background threads, so that reading overlaps with
+# the profile calculations.  Tiles for all AOIs are resolved up front with a single
+# batch query of the tile index.  The tile cache in use (or a new 4 GB cache if
+# caching is not enabled) should be large enough to hold the tiles for lookahead+1
+# AOIs, otherwise prefetched tiles may be evicted before they are used.
+def iterate_lidar_data_by_polygons(file_list,polygons,compact=False,lookahead=2,n_workers=2,cache=None):
+    filters = [lambda pts,polygon=polygon: filter_lidar_data_by_polygon(pts,polygon) for polygon in polygons]
+    return _iterate_aois(file_list,polygons,filters,compact,lookahead,n_workers,cache,skip_contained=True)
+
+# As above, for circular neighbourhoods of a given radius around a sequence of points
+def iterate_lidar_data_by_neighbourhoods(file_list,xys,radius,compact=False,lookahead=2,n_workers=2,cache=None):
+    polygons = [np.asarray([[xy[0]+radius,xy[1]+radius], [xy[0]+radius,xy[1]-radius], [xy[0]-radius,xy[1]-radius], [xy[0]-radius,xy[1]+radius]]) for xy in xys]
+    filters = [lambda pts,xy=xy: filter_lidar_data_by_neighbourhood(pts,xy,radius) for xy in xys]
+    return _iterate_aois(file_list,polygons,filters,compact,lookahead,n_workers,cache)
+
+# If skip_contained, tiles that lie wholly within an AOI's polygon are not filtered.
+def _iterate_aois(file_list,polygons,filters,compact,lookahead,n_workers,cache,skip_contained=False):
+    if cache is None:
+        cache = tile_cache if tile_cache is not None else TileCache()
+    classified = classify_las_files_by_polygons(file_list,polygons)
+    keep_files = [keep for keep,contained in classified]
+    n_aois = len(polygons)
+    pool = ThreadPool(n_workers)
+    pending = {}
+    try:
+        for aoi in range(0,n_aois):
+            # queue up the tiles for this and the next few AOIs
+            for ahead in range(aoi,min(aoi+lookahead+1,n_aois)):
+                for las_file in keep_files[ahead]:
+                    if las_file not in pending:
+                        pending[las_file] = pool.apply_async(cache.get,(las_file,compact))
+            # wait for this AOI's tiles (re-raising any errors from the reading threads)
+            for las_file in keep_files[aoi]:
+                pending.pop(las_file).get()
+            if skip_contained:
+                tile_filters = [None if contained else filters[aoi] for contained in classified[aoi][1]]
+            else:
+                tile_filters = filters[aoi]
+            yield load_and_filter_tiles(keep_files[aoi],tile_filters,compact,n_workers=1,cache=cache)
+    finally:
+        pool.close()
+        pool.join()
+
 # This function writes a set of lidar returns into a csv file, so that the same 
-# point cloud samples can be loaded into different software packages
-def points_to_csv(pts,outfile):
+# point cloud samples can be loaded into different software packages.  Points are
+# formatted a chunk at a time with a single string formatting operation per chunk.
+# Values are written with repr, i.e. the shortest string that round trips exactly.
+def points_to_csv(pts,outfile,chunk_size=100000):
     n_pts,temp = pts.shape
     f = open(outfile,"w") #opens file
     f.write("X, Y, Z, k, Class, A\n")
-    for i in range(0,n_pts):
-        f.write(str(pts[i,0])+','+str(pts[i,1])+','+str(pts[i,2])+','+str(pts[i,3])+','+str(pts[i,4])+','+str(pts[i,5])+'\n')
+    row_fmt = ','.join(['%r']*6)+'\n'
+    for start in range(0,n_pts,chunk_size):
+        block = _points_block(pts,slice(start,min(start+chunk_size,n_pts)))
+        f.write((row_fmt*block.shape[0]) % tuple(block.ravel()))
     f.close()
+
+# Standard Nx6 float array for the rows of any of the point array types
+def _points_block(pts,rows):
+    if isinstance(pts,np.ndarray):
+        return pts[rows,:]
+    block = pts[rows,:]
+    if isinstance(block,np.ndarray):
+        return block
+    return block.to_array()
+
+# Save points to a numpy .npz file.  Compact point clouds are stored as their records
+# plus scale and offset, so they round trip without loss.
+def points_to_npz(pts,outfile):
+    if isinstance(pts,PointSelection):
+        pts = pts.materialise()
+    if isinstance(pts,CompactPointCloud):
+        np.savez(outfile,records=pts.records,scale=pts.scale,offset=pts.offset)
+    elif isinstance(pts,LasPointMap):
+        np.savez(outfile,pts=pts.to_array())
+    else:
+        np.savez(outfile,pts=pts)
+
+# Load points saved with points_to_npz
+def load_points_npz(infile):
+    npz = np.load(infile)
+    if 'records' in npz.files:
+        pts = CompactPointCloud(npz['records'],npz['scale'],npz['offset'])
+    else:
+        pts = npz['pts']
+    npz.close()
+    return pts
+
+# Save points as a raw .npy file (Nx6 float array), e.g. for use with other software
+def points_to_npy(pts,outfile):
+    if isinstance(pts,np.ndarray):
+        np.save(outfile,pts)
+    else:
+        np.save(outfile,pts.to_array())
+
+# Write points to a las file, using the header (point format, scale and offset) of the
+# las file they were loaded from, so that the coordinates are written back onto the
+# same grid.  The raw integer records are built a chunk at a time.
+def points_to_las(pts,outfile,source_las_file,chunk_size=1000000):
+    source = las.file.File(source_las_file,mode='r')
+    outFile = las.file.File(outfile,mode='w',header=source.header)
+    scale = np.asarray(source.header.scale,dtype='float')
+    offset = np.asarray(source.header.offset,dtype='float')
+    n_pts = pts.shape[0]
+    XYZ = np.zeros((n_pts,3),dtype='int32')
+    attributes = np.zeros((n_pts,3),dtype='int16')
+    for start in range(0,n_pts,chunk_size):
+        rows = slice(start,min(start+chunk_size,n_pts))
+        for cc in range(0,3):
+            XYZ[rows,cc] = np.round((pts[rows,cc]-offset[cc])/scale[cc])
+            attributes[rows,cc] = pts[rows,cc+3]
+    outFile.X = XYZ[:,0]
+    outFile.Y = XYZ[:,1]
+    outFile.Z = XYZ[:,2]
+    outFile.return_num = attributes[:,0]
+    outFile.classification = attributes[:,1]
+    if source.header.data_format_id < 6:
+        outFile.scan_angle_rank = attributes[:,2]
+    else:
+        outFile.scan_angle = np.round(attributes[:,2]/0.006)
+    outFile.header.update_min_max()
+    outFile.close()
+    source.close()
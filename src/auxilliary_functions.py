@@ -101,3 +101,93 @@ def get_bounding_box_with_buffer(coordinate_list,buffer_width):
     bbox[3,0]=left
     bbox[3,1]=bottom
     return bbox
+
+# PlotGrid describes a plot that is divided into a regular grid of square subplots (e.g.
+# the 5x5 grid of 20 m subplots in each carbon plot).  The grid is defined in local plot
+# coordinates (metres from the plot origin) and mapped to map coordinates by a 2D affine
+# transformation, as fitted in create_subplot_grids_least_squares_affine_transformation.py.
+# Points are assigned to cells by applying the inverse transformation and flooring, which
+# needs no polygon tests.  labels gives the subplot number for each cell in row-major
+# order, with '_' for cells that are not part of the plot.
+class PlotGrid(object):
+
+    def __init__(self,affine,rows,cols,cell_size=20.,labels=None):
+        self.affine = np.asarray(affine,dtype='float')
+        self.inverse = np.linalg.inv(self.affine)
+        self.rows = rows
+        self.cols = cols
+        self.cell_size = cell_size
+        if labels is None:
+            labels = ['%02i' % (i+1) for i in range(0,rows*cols)]
+        self.labels = labels
+        # subplot index (position in the subplot list) for each cell, -1 if not used
+        self.cell_subplot = np.zeros(rows*cols,dtype='int64')-1
+        used = np.asarray([label != '_' for label in labels])
+        self.cell_subplot[used] = np.arange(used.sum())
+
+    # row and column of the cell containing each point (-1 for points outside the grid)
+    def assign_cells(self,x,y):
+        u = self.inverse[0,0]*x + self.inverse[0,1]*y + self.inverse[0,2]
+        v = self.inverse[1,0]*x + self.inverse[1,1]*y + self.inverse[1,2]
+        col = np.floor(u/self.cell_size).astype('int64')
+        row = np.floor(v/self.cell_size).astype('int64')
+        outside = (col<0) | (col>=self.cols) | (row<0) | (row>=self.rows)
+        col[outside] = -1
+        row[outside] = -1
+        return row, col
+
+    # subplot index (position in subplot_polygons/subplot_labels) for each point, -1 if
+    # the point is not in any subplot
+    def label_points(self,x,y):
+        row,col = self.assign_cells(x,y)
+        labels = np.zeros(x.size,dtype='int64')-1
+        inside = row>=0
+        labels[inside] = self.cell_subplot[row[inside]*self.cols+col[inside]]
+        return labels
+
+    # map coordinates of the grid nodes, as (rows+1)x(cols+1) arrays
+    def grid_nodes(self):
+        xv,yv = np.meshgrid(np.arange(0,self.cols+1.)*self.cell_size,np.arange(0,self.rows+1.)*self.cell_size)
+        x_prime = self.affine[0,0]*xv + self.affine[0,1]*yv + self.affine[0,2]
+        y_prime = self.affine[1,0]*xv + self.affine[1,1]*yv + self.affine[1,2]
+        return x_prime, y_prime
+
+    # subplot corner polygons and labels in the format returned by load_boundaries for a
+    # single plot: an (n_subplots,5,2) array of closed polygons and an array of subplot
+    # numbers
+    def subplot_polygons(self):
+        x_prime,y_prime = self.grid_nodes()
+        polygons = []
+        subplots = []
+        count = 0
+        for i in range(0,self.rows):
+            for j in range(0,self.cols):
+                if self.labels[count] != '_':
+                    polygons.append([[x_prime[i,j],y_prime[i,j]], [x_prime[i+1,j],y_prime[i+1,j]],
+                                     [x_prime[i+1,j+1],y_prime[i+1,j+1]], [x_prime[i,j+1],y_prime[i,j+1]],
+                                     [x_prime[i,j],y_prime[i,j]]])
+                    subplots.append(float(self.labels[count]))
+                count+=1
+        return np.asarray(polygons), np.asarray(subplots)
+
+# Fit the affine transformation from local plot coordinates (x,y) to map coordinates
+# (x_prime,y_prime) by least squares, given a set of matching points (e.g. GPS points at
+# known grid positions), and return the corresponding PlotGrid
+def fit_plot_grid(x,y,x_prime,y_prime,rows,cols,cell_size=20.,labels=None):
+    n_points = x.size
+    A = np.zeros((2*n_points,6))
+    b = np.zeros(2*n_points)
+    A[:n_points,0] = x
+    A[:n_points,1] = y
+    A[:n_points,2] = 1
+    A[n_points:,3] = x
+    A[n_points:,4] = y
+    A[n_points:,5] = 1
+    b[:n_points] = x_prime
+    b[n_points:] = y_prime
+    h, res, rank, s = np.linalg.lstsq(A,b)
+    affine = np.zeros((3,3))
+    affine[0,:] = h[:3]
+    affine[1,:] = h[3:]
+    affine[2,2] = 1
+    return PlotGrid(affine,rows,cols,cell_size,labels)
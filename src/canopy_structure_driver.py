@@ -12,6 +12,7 @@ import LiDAR_tools as lidar
 import auxilliary_functions as aux
 import LiDAR_MacHorn_LAD_profiles as LAD1
 import LiDAR_radiative_transfer_LAD_profiles as LAD2
+import LiDAR_return_counts as counts
 import structural_metrics as structure
 import plot_LAD_profiles as plot_LAD
 
@@ -56,10 +57,13 @@ for pp in range(0,N_plots):
     n_coord_pairs = subplot_polygons[Plot_name].shape[0]*subplot_polygons[Plot_name].shape[1]
     coord_pairs = subplot_polygons[Plot_name].reshape(n_coord_pairs,2)
     bbox_polygon = aux.get_bounding_box(coord_pairs)
-    plot_lidar_pts = lidar.filter_lidar_data_by_polygon(all_lidar_pts,bbox_polygon)
+    # (the plot-level clip is kept as a lazy selection to avoid copying the point cloud)
+    plot_lidar_pts = lidar.filter_lidar_data_by_polygon(lidar.lazy_selection(all_lidar_pts),bbox_polygon)
     
     # get some subplot-level information
     n_subplots = subplot_polygons[Plot_name].shape[0]
+    # assign the plot's points to subplots in a single pass
+    subplot_lidar_pts = lidar.filter_lidar_data_by_polygons(plot_lidar_pts,subplot_polygons[Plot_name])
 
     # set up some arrays to host the radiative transfer based profiles
     heights_rad = np.arange(0,max_height+1)
@@ -88,7 +92,7 @@ for pp in range(0,N_plots):
         print "Subplot: ", subplot_labels[Plot_name][i]
         subplot_index = subplot_labels[Plot_name][i]-1 # this is so that the subplots are stored in a logical order
         # filter lidar points into subplot
-        sp_pts = lidar.filter_lidar_data_by_polygon(plot_lidar_pts,subplot_polygons[Plot_name][i,:,:])
+        sp_pts = subplot_lidar_pts[i].materialise()
         """
         for p in range(0,sp_pts.shape[0]):
             out.write(str(sp_pts[p,0]) + ',' + str(sp_pts[p,1]) + ',' + str(sp_pts[p,2]) + ',' +  Plot_name + ',' + str(subplot_labels[Plot_name][i])+'\n')
@@ -97,13 +101,17 @@ for pp in range(0,N_plots):
         """
 
 
+        # count the returns once at the finest layer thickness; the profiles at coarser
+        # resolutions are derived from these counts
+        sp_bbox = [np.min(sp_pts[:,0]),np.min(sp_pts[:,1]),np.max(sp_pts[:,0]),np.max(sp_pts[:,1])]
+        sp_counts = counts.ReturnCountAccumulator(sp_bbox,None,max_height,layer_thickness).add(sp_pts)
+        sp_counts_2m = sp_counts.coarsen(int(round(layer_thickness_2m/float(layer_thickness))))
+
         # first of all, loop through the return numbers to calculate the radiative LAD profiles, accounting for imperfect penetration of LiDAR pulses into canopy
         for rr in range(0,max_return):
             max_k=rr+1
-            u,n,I,U = LAD2.calculate_LAD_DTM(sp_pts,heights_rad,max_k,'spherical')
-            LAD_rad_DTM[subplot_index,:,rr]=u[::-1].copy()
-            u,n,I,U = LAD2.calculate_LAD_DTM(sp_pts,heights_rad_2m,max_k,'spherical')
-            LAD_rad_2m[subplot_index,:,rr]=u[::-1].copy()
+            heights_rad,LAD_rad_DTM[subplot_index,:,rr] = sp_counts.LAD_radiative_transfer(max_k,None,'spherical')
+            heights_rad_2m,LAD_rad_2m[subplot_index,:,rr] = sp_counts_2m.LAD_radiative_transfer(max_k,None,'spherical')
             #u,n,I,U = LAD2.calculate_LAD_DTM(sp_pts,heights_rad_5m,max_k,'spherical')
             #LAD_rad_5m[i,:,rr]=u[::-1].copy()
 
@@ -114,12 +122,12 @@ for pp in range(0,N_plots):
             #LAD_rad_2m_noS[i,:,rr]=u[::-1].copy()
 
         # now get MacArthur-Horn profiles
-        heights,first_return_profile,n_ground_returns = LAD1.bin_returns(sp_pts, max_height, layer_thickness)
-        LAD_MH[subplot_index,:] = LAD1.estimate_LAD_MacArtherHorn(first_return_profile, n_ground_returns, layer_thickness, 1.)
-        heights_2m,first_return_profile,n_ground_returns = LAD1.bin_returns(sp_pts, max_height, layer_thickness_2m)
-        LAD_MH_2m[subplot_index,:] = LAD1.estimate_LAD_MacArtherHorn(first_return_profile, n_ground_returns, layer_thickness_2m, 1.)
+        heights,LAD,LAI = sp_counts.LAD_MacArthurHorn(1.,None)
+        LAD_MH[subplot_index,:] = LAD[0,0]
+        heights_2m,LAD,LAI = sp_counts_2m.LAD_MacArthurHorn(1.,None)
+        LAD_MH_2m[subplot_index,:] = LAD[0,0]
         #heights_5m,first_return_profile,n_ground_returns = LAD1.bin_returns(sp_pts, max_height, layer_thickness_5m)
-        #LAD_MH_5m[i,:] = LAD1.estimate_LAD_MacArtherHorn(first_return_profile, n_ground_returns, layer_thickness_5m, 1.)
+        #LAD_MH_5m[i,:] = LAD1.estimate_LAD_MacArthurHorn(first_return_profile, n_ground_returns, layer_thickness_5m, 1.)
 
     # now we have looped through and created the different profiles, need to account for any NaN's and apply minimum height
     # to the LAD distributions
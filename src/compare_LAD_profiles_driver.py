@@ -84,7 +84,7 @@ for pp in range(0,N_plots):
         heights,subplot_lidar_profiles[i,:],n_ground_returns[i] = LAD1.bin_returns(sp_pts, max_height, layer_thickness)
         subplot_LAI[i] = field_LAI['LAI'][np.all((field_LAI['Subplot']==subplot_labels[Plot_name][i],field_LAI['Plot']==Plot_name),axis=0)]
 
-        subplot_LAD_profiles_native[i,:] = LAD1.estimate_LAD_MacArtherHorn(subplot_lidar_profiles[i,:],n_ground_returns[i],layer_thickness,1.)
+        subplot_LAD_profiles_native[i,:] = LAD1.estimate_LAD_MacArthurHorn(subplot_lidar_profiles[i,:],n_ground_returns[i],layer_thickness,1.)
 
         u,n,I,U = LAD2.calculate_LAD(sp_pts,heights_rad,1,'spherical')
         subplot_LAD_profiles_spherical_1stOnly[i,:]=u.copy()
@@ -0,0 +1,56 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import laspy as las
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','src'))
+import LiDAR_tools as lidar
+
+# write a las file with n_pts random points in a 100 m square tile with lower left
+# corner (x0,y0), on a 1 cm grid offset to that corner
+def write_tile(las_file,x0,y0,n_pts,seed=0):
+    header = las.header.Header(point_format=1)
+    lasFile = las.file.File(las_file,mode='w',header=header)
+    lasFile.header.scale = [0.01,0.01,0.01]
+    lasFile.header.offset = [x0,y0,0.]
+    if n_pts > 0:
+        rs = np.random.RandomState(seed)
+        lasFile.x = x0+rs.uniform(0,100,n_pts)
+        lasFile.y = y0+rs.uniform(0,100,n_pts)
+        lasFile.z = rs.uniform(0,40,n_pts)
+        lasFile.return_num = rs.randint(1,4,n_pts)
+        lasFile.num_returns = np.zeros(n_pts,dtype='int')+3
+        lasFile.classification = rs.randint(1,3,n_pts)
+        lasFile.scan_angle_rank = rs.randint(-15,16,n_pts)
+    lasFile.close()
+
+class EmptyTileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.empty = os.path.join(self.folder,'empty.las')
+        self.tiles = [os.path.join(self.folder,'tile_a.las'),os.path.join(self.folder,'tile_b.las')]
+        write_tile(self.empty,1000.,2000.,0)
+        write_tile(self.tiles[0],1000.,2000.,1000,seed=1)
+        write_tile(self.tiles[1],1100.,2000.,1000,seed=2)
+        self.expected = np.concatenate([lidar.load_lidar_data(las_file) for las_file in self.tiles],axis=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_empty_file_keeps_its_grid(self):
+        pts = lidar.load_lidar_data(self.empty,compact=True)
+        self.assertEqual(len(pts),0)
+        np.testing.assert_array_equal(pts.scale,[0.01,0.01,0.01])
+        np.testing.assert_array_equal(pts.offset,[1000.,2000.,0.])
+
+    def test_empty_first_tile_does_not_regrid_others(self):
+        pts = lidar.load_and_filter_tiles([self.empty]+self.tiles,lambda tile_pts: tile_pts,compact=True)
+        np.testing.assert_array_equal(pts.scale,[0.01,0.01,0.01])
+        np.testing.assert_allclose(pts.to_array(),self.expected,rtol=0,atol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()